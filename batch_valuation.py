@@ -0,0 +1,243 @@
+import argparse
+import multiprocessing as mp
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from dataset_cache import load_clean_data
+from evaluation_store import read_params
+from validate_algo import INPUT_FILE, LOOKBACK_DAYS, MODEL_PARAMS, use_params
+from valuation_engine import (
+    COHORT_KEYS, FLAG_COLUMNS, REQUIRED_FIELDS, TARGET_DEFAULTS, TRUE_VALUES, CohortIndex, add_feature_codes,
+    age_in_months, predict_batch,
+)
+
+# Batch valuation of a file of cars (e.g. a leasing partner's fleet list).
+# Targets use the columns of tesla_final_clean.csv without the price fields;
+# every car is valued as of one reference date, from the auctions that ended
+# before it, at its age on that date (from first_registration;
+# age_at_auction_months is only used for rows without a parseable
+# registration). Targets are grouped by cohort and cut into shards of at most
+# SHARD_SIZE cars, which a process pool values with predict_batch(). With the
+# 'fork' start method the workers inherit the comparables index copy-on-write;
+# only shard row numbers go to the workers. Results are appended to the output
+# (CSV, or Parquet if pyarrow is installed) as shards finish, in shard order.
+#
+#   python batch_valuation.py fleet.csv --date 2026-03-01 --output fleet_valued.csv
+#
+# Output: the input columns plus input_row (line order of the input),
+# predicted_price, neighbors, neighbor_ids (';'-separated) and error (why a
+# row could not be valued). Rows are grouped by cohort; sort by input_row to
+# restore the input order.
+
+SHARD_SIZE = 2_000
+PROGRESS_EVERY = 1.0  # Seconds between progress lines
+
+
+def prepare_targets(raw, reference_date):
+    # -> (targets ready for predict_batch(), error per row ('' if valid))
+    missing = [field for field in REQUIRED_FIELDS if field not in raw.columns]
+    if missing:
+        raise SystemExit(f"Target file is missing column(s): {', '.join(missing)}")
+
+    targets = raw.copy()
+    for column, default in TARGET_DEFAULTS.items():
+        targets[column] = targets[column].fillna(default) if column in targets.columns else default
+    for column in FLAG_COLUMNS:
+        targets[column] = targets[column].astype(str).str.lower().isin(TRUE_VALUES)
+    targets['end_time'] = reference_date
+    targets['mileage'] = pd.to_numeric(targets['mileage'], errors='coerce')
+
+    # Age at the reference date; a given age_at_auction_months was measured at
+    # the car's own auction, so it only fills in missing registrations
+    age = pd.Series(np.nan, index=targets.index)
+    if 'first_registration' in targets.columns:
+        registered = pd.to_datetime(targets['first_registration'], format='ISO8601', errors='coerce')
+        age = age_in_months(reference_date, registered).astype(float)
+    if 'age_at_auction_months' in targets.columns:
+        age = age.fillna(pd.to_numeric(targets['age_at_auction_months'], errors='coerce').astype(float))
+    targets['age_at_auction_months'] = age
+
+    errors = pd.Series('', index=targets.index, dtype=object)
+    errors[age.isna()] = 'age_at_auction_months or first_registration is required'
+    errors[~targets['model'].isin(['Model 3', 'Model Y'])] = "model must be 'Model 3' or 'Model Y'"
+    for field in REQUIRED_FIELDS:
+        errors[targets[field].isna()] = f"missing field: {field}"
+    return targets, errors
+
+
+def make_shards(targets, shard_size=SHARD_SIZE):
+    # Positional row numbers per shard: one cohort per shard, at most shard_size cars
+    keys = targets[COHORT_KEYS].astype({'is_highland': bool})
+    shards = []
+    for members in keys.groupby(COHORT_KEYS, sort=True, observed=True).indices.values():
+        shards += [members[start:start + shard_size] for start in range(0, len(members), shard_size)]
+    return shards
+
+
+def result_frame(raw, rows, predictions=None, errors=None):
+    # Output rows for raw.iloc[rows]
+    frame = raw.iloc[rows].copy()
+    frame['input_row'] = rows
+    if predictions is None:
+        frame['predicted_price'] = np.nan
+        frame['neighbors'] = 0
+        frame['neighbor_ids'] = ''
+    else:
+        frame['predicted_price'] = predictions['predicted_price'].to_numpy(dtype=np.float64)
+        frame['neighbors'] = predictions['neighbors'].to_numpy(dtype=np.int64)
+        frame['neighbor_ids'] = [';'.join(map(str, ids)) for ids in predictions['neighbor_ids']]
+    frame['error'] = errors.iloc[rows].to_numpy() if errors is not None else ''
+    return frame
+
+
+# Read-only state of a worker process (see optimize_algo.py): filled by the
+# parent before a 'fork' pool starts, or by the initializer under 'spawn'
+_worker_state = {}
+
+def _init_worker(raw, targets, index):
+    _worker_state.update(raw=raw, targets=targets, index=index)
+
+def _value_shard(rows):
+    state = _worker_state
+    predictions = predict_batch(state['targets'].iloc[rows], state['index'], MODEL_PARAMS)
+    return result_frame(state['raw'], rows, predictions)
+
+
+def value_shards(shards, raw, targets, index, workers):
+    # Yields the result frame of every shard, in shard order
+    _init_worker(raw, targets, index)
+    if workers <= 1:
+        for rows in shards:
+            yield _value_shard(rows)
+        return
+    if 'fork' in mp.get_all_start_methods():
+        pool = mp.get_context('fork').Pool(workers)
+    else:
+        pool = mp.get_context('spawn').Pool(workers, initializer=_init_worker, initargs=(raw, targets, index))
+    with pool:
+        yield from pool.imap(_value_shard, shards)
+
+
+class CsvSink:
+    def __init__(self, path):
+        self.path = path
+        self.header = True
+
+    def write(self, frame):
+        frame.to_csv(self.path, mode='w' if self.header else 'a', header=self.header, index=False)
+        self.header = False
+
+    def close(self):
+        if self.header:
+            # Nothing was written: still leave a valid (empty) file
+            open(self.path, 'w').close()
+
+
+class ParquetSink:
+    def __init__(self, path):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("Parquet output needs pyarrow (pip install pyarrow); use a .csv output instead") from None
+        self.pa, self.pq = pa, pq
+        self.path = path
+        self.writer = None
+
+    def write(self, frame):
+        if self.writer is None:
+            table = self.pa.Table.from_pandas(frame, preserve_index=False)
+            self.writer = self.pq.ParquetWriter(self.path, table.schema)
+        else:
+            table = self.pa.Table.from_pandas(frame, schema=self.writer.schema, preserve_index=False)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def open_sink(path):
+    return ParquetSink(path) if path.endswith('.parquet') else CsvSink(path)
+
+
+class Progress:
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.started = time.perf_counter()
+        self.shown = self.started
+
+    def rate(self):
+        return self.done / max(time.perf_counter() - self.started, 1e-9)
+
+    def update(self, n):
+        self.done += n
+        now = time.perf_counter()
+        if now - self.shown >= PROGRESS_EVERY or self.done == self.total:
+            self.shown = now
+            print(f"  {self.done:,}/{self.total:,} cars ({self.done / max(self.total, 1):.0%}), {self.rate():,.0f} cars/sec",
+                  file=sys.stderr, flush=True)
+
+
+def value_file(target_path, output_path, reference_date, workers, data_path=INPUT_FILE, shard_size=SHARD_SIZE,
+               lookback_days=LOOKBACK_DAYS):
+    # -> (cars valued, cars that could not be valued, seconds)
+    started = time.perf_counter()
+    sink = open_sink(output_path)
+    df = add_feature_codes(load_clean_data(data_path))
+    index = CohortIndex(df, lookback_days)
+    raw = pd.read_csv(target_path)
+    targets, errors = prepare_targets(raw, reference_date)
+    valid = (errors == '').to_numpy()
+    shards = make_shards(targets[valid], shard_size)
+    valid_rows = np.flatnonzero(valid)
+    shards = [valid_rows[rows] for rows in shards]
+    print(f"{len(raw):,} cars as of {reference_date.date()}: {valid.sum():,} in {len(shards)} shard(s) "
+          f"on {workers} worker(s), {len(raw) - valid.sum():,} invalid; {len(index):,} comparables", file=sys.stderr)
+
+    progress = Progress(len(raw))
+    not_valued = 0
+    try:
+        if not valid.all():
+            invalid = result_frame(raw, np.flatnonzero(~valid), errors=errors)
+            sink.write(invalid)
+            not_valued += len(invalid)
+            progress.update(len(invalid))
+        for frame in value_shards(shards, raw, targets, index, workers):
+            sink.write(frame)
+            not_valued += int((frame['neighbors'] == 0).sum())
+            progress.update(len(frame))
+    finally:
+        sink.close()
+    return len(raw) - not_valued, not_valued, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Value a file of cars as of a reference date.")
+    parser.add_argument('targets', help="CSV of target cars (columns of tesla_final_clean.csv, no prices needed)")
+    parser.add_argument('--date', help="Reference date the cars are valued at (default: today, UTC)")
+    parser.add_argument('--output', help="Output .csv or .parquet (default: <targets>_valued.csv)")
+    parser.add_argument('--workers', type=int, default=0, help=f"Worker processes (0 = all {os.cpu_count()} cores, 1 = in-process)")
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE, help="Maximum cars per shard")
+    parser.add_argument('--input', default=INPUT_FILE, help="Cleaned data set of comparables")
+    parser.add_argument('--params', metavar='JSON', help="Use the weights in this file instead of the pinned ones")
+    parser.add_argument('--lookback-days', type=int, default=LOOKBACK_DAYS, help="Only use comparables that ended at most this many days before the reference date")
+    args = parser.parse_args()
+
+    if args.params:
+        use_params(read_params(args.params))
+    reference_date = pd.Timestamp(args.date) if args.date else pd.Timestamp.now(tz='UTC').tz_localize(None).normalize()
+    output = args.output or os.path.splitext(args.targets)[0] + '_valued.csv'
+    valued, not_valued, seconds = value_file(
+        args.targets, output, reference_date, args.workers or os.cpu_count(), args.input, args.shard_size, args.lookback_days)
+    total = valued + not_valued
+    print(f"Valued {valued:,} of {total:,} cars in {seconds:.1f}s ({total / max(seconds, 1e-9):,.0f} cars/sec) -> {output}")
+
+
+if __name__ == "__main__":
+    main()
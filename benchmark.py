@@ -0,0 +1,272 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+import clean_data_final
+import optimize_algo
+import validate_algo
+from dataset_cache import load_clean_data
+from valuation_cache import ValuationCache
+from valuation_engine import CohortIndex, add_feature_codes, build_feature_deltas, predict_batch
+
+# Benchmark harness for the valuation engine. Times single-target latency
+# (predict_valuation), batch throughput (predict_batch), one optimizer iteration
+# (evaluate_weights on prebuilt deltas) and the cleaning pipeline, on the real
+# data set and on synthetic ones resampled from it. Every run is appended as one
+# JSON line to RESULTS_FILE, tagged with the git commit, so runs on different
+# commits can be compared (--compare).
+
+INPUT_FILE = 'tesla_final_clean.csv'
+RESULTS_FILE = 'benchmark_results.jsonl'
+SIZES = [10_000, 100_000, 1_000_000]  # Synthetic data set sizes (auctions)
+SEED = 42
+LATENCY_TARGETS = 200   # Single-target valuations timed per data set
+BATCH_TARGETS = 2_000   # Most recent closed auctions valued in the batch benchmark
+OPTIMIZER_EVALS = 20    # evaluate_weights() calls timed per data set
+BENCHMARKS = ['latency', 'batch', 'optimizer', 'cleaning']
+
+# Representative raw export values per cleaned category, for synthetic exports
+EXPORT_POWER_KW = {'m3_sr': 208, 'm3_lr': 366, 'm3_p': 460, 'my_sr': 220, 'my_lr': 378, 'my_p': 390}
+EXPORT_HIGHLAND_POWER_KW = {'m3_sr': 235, 'm3_p': 461}
+EXPORT_TYRES = {
+    '8_tires': '[{"type": "summer"}, {"type": "winter"}]',
+    '4_summer': '[{"type": "summer"}]',
+    '4_winter': '[{"type": "winter"}]',
+    '4_all_season': '[{"type": "all_season"}]',
+}
+EXPORT_AUTOPILOT = {'FSD': 'Full self driving', 'EAP': 'Enhanced', 'Standard': 'Standard'}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def timed(fn, repeat=1):
+    # -> (seconds of each call, result of the last call)
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - started)
+    return times, result
+
+
+def synthesize(df, n, seed=SEED):
+    # Synthetic cleaned data set of n auctions drawn from the columns of `df`.
+    # Whole rows are resampled so categorical combinations stay realistic;
+    # end times are spread over the same period, registrations follow from the
+    # sampled age, and mileage and price are jittered.
+    rng = np.random.default_rng(seed)
+    synth = df.iloc[rng.integers(0, len(df), n)].reset_index(drop=True)
+    synth['auction_id'] = [f'synth-{seed}-{i}' for i in range(n)]
+
+    start, stop = df['end_time'].min().value, df['end_time'].max().value
+    end_ns = rng.integers(start, stop, n, endpoint=True)
+    synth['end_time'] = pd.to_datetime(end_ns).floor('h')
+
+    age_days = synth['age_at_auction_months'].to_numpy() * 30.44 + rng.uniform(0, 30, n)
+    synth['first_registration'] = (synth['end_time'] - pd.to_timedelta(age_days, unit='D')).dt.normalize()
+    synth['age_at_auction_months'] = ((synth['end_time'] - synth['first_registration']) / pd.Timedelta(days=30.44)).astype(int)
+
+    synth['mileage'] = (synth['mileage'] * rng.lognormal(0, 0.1, n)).round().astype(np.int64)
+    synth['final_price'] = (synth['final_price'] * rng.normal(1, 0.03, n) / 100).round() * 100
+    return synth
+
+
+def to_export(clean):
+    # Raw export rows that clean_data_final.py translates back into `clean`
+    # (closely enough to exercise every step of the cleaning pipeline)
+    highland = clean['is_highland'].to_numpy(dtype=bool)
+    variant = clean['variant_clean'].astype(str)
+    kw = variant.map(EXPORT_POWER_KW)
+    kw = kw.where(~highland, variant.map(EXPORT_HIGHLAND_POWER_KW).fillna(kw))
+    vat = (clean['tax_type'] == 'vat').to_numpy()
+    return pd.DataFrame({
+        'auction_id': clean['auction_id'],
+        'model': clean['model'],
+        'power_kw': kw,
+        'variant': np.where(highland, 'Highland', 'Long Range'),
+        'first_registration': pd.to_datetime(clean['first_registration']).dt.strftime('%Y-%m-%d'),
+        'seller_type': np.where(vat, 'company', 'private'),
+        'taxation': np.where(vat, 'vat_deductible', 'margin'),
+        'accident_free_seller': np.where(clean['is_accident_free'], 't', 'f'),
+        'accident_free_cardentity': 't',
+        'tyres': clean['tire_strategy'].astype(str).map(EXPORT_TYRES),
+        'trailer_hitch_seller': np.where(clean['has_hitch'], 't', 'f'),
+        'tesla_autopilot': clean['autopilot'].astype(str).map(EXPORT_AUTOPILOT),
+        'heatpump': np.where(clean['has_heatpump'], 't', 'f'),
+        'mileage': clean['mileage'],
+        'end_time': clean['end_time'].dt.strftime('%Y-%m-%d %H:%M:%S+00'),
+        'highest_bid_amount': clean['final_price'],
+        'status': clean['status'],
+        'number_of_bids': clean['number_of_bids'],
+    })
+
+
+def bench_latency(df, index):
+    targets = validate_algo.closed_auctions(df).sort_values('end_time').tail(LATENCY_TARGETS)
+    times = []
+    for _, target in targets.iterrows():
+        started = time.perf_counter()
+        validate_algo.predict_valuation(target, index, cache=None)
+        times.append(time.perf_counter() - started)
+    times = np.array(times) * 1e3
+
+    # Repeated lookups of the same targets, answered by a warm valuation cache
+    cache = ValuationCache()
+    records = [target.to_dict() for _, target in targets.iterrows()]
+    for target in records:
+        validate_algo.predict_valuation(target, index, cache=cache)
+    cached_times, _ = timed(lambda: [validate_algo.predict_valuation(target, index, cache=cache) for target in records])
+    return {
+        'targets': len(times),
+        'median_ms': float(np.median(times)),
+        'p95_ms': float(np.percentile(times, 95)),
+        'max_ms': float(times.max()),
+        'cached_mean_us': cached_times[0] / len(records) * 1e6,
+    }
+
+
+def bench_batch(df, index):
+    targets = validate_algo.closed_auctions(df).sort_values('end_time').tail(BATCH_TARGETS)
+    times, _ = timed(lambda: predict_batch(targets, index, validate_algo.MODEL_PARAMS))
+    return {
+        'targets': len(targets),
+        'seconds': times[0],
+        'cars_per_sec': len(targets) / times[0],
+    }
+
+
+def bench_optimizer(df):
+    priced = df[df['final_price'].notna()]
+    val_set = optimize_algo.get_validation_set(priced, n=optimize_algo.VALIDATION_SIZE)
+    index_times, index = timed(lambda: CohortIndex(priced))
+    delta_times, deltas = timed(lambda: build_feature_deltas(val_set, index, optimize_algo.PRICE_ADJUSTMENTS))
+    rng = np.random.default_rng(SEED)
+    candidates = [optimize_algo.generate_random_weights(rng) for _ in range(OPTIMIZER_EVALS)]
+    eval_times = []
+    for weights in candidates:
+        times, _ = timed(lambda: optimize_algo.evaluate_weights(weights, deltas))
+        eval_times.append(times[0])
+    return {
+        'targets': len(val_set),
+        'candidates': len(deltas['adjusted_price']),
+        'index_seconds': index_times[0],
+        'deltas_seconds': delta_times[0],
+        'median_eval_ms': float(np.median(eval_times) * 1e3),
+        'evals_per_sec': 1 / float(np.median(eval_times)),
+    }
+
+
+def bench_cleaning(clean, workdir):
+    export_path = os.path.join(workdir, 'export.csv')
+    to_export(clean).to_csv(export_path, index=False)
+    output_path = os.path.join(workdir, 'clean.csv')
+    quarantine_path = os.path.join(workdir, 'quarantine.csv')
+    times, rows = timed(lambda: clean_data_final.clean_export(export_path, output_path, quarantine_path=quarantine_path))
+    return {
+        'rows': rows,
+        'seconds': times[0],
+        'rows_per_sec': rows / times[0],
+    }
+
+
+def run_dataset(name, df, benchmarks, workdir):
+    # -> list of result records for one data set
+    df = add_feature_codes(df)
+    records = []
+
+    def record(benchmark, metrics):
+        records.append({'dataset': name, 'rows': len(df), 'benchmark': benchmark, **metrics})
+        shown = ', '.join(f"{key}={value:.4g}" if isinstance(value, float) else f"{key}={value}" for key, value in metrics.items())
+        print(f"  {benchmark:<10} {shown}")
+
+    print(f"\n{name} ({len(df)} auctions)")
+    index_times, index = timed(lambda: CohortIndex(df))
+    record('index', {'seconds': index_times[0]})
+    if 'latency' in benchmarks:
+        record('latency', bench_latency(df, index))
+    if 'batch' in benchmarks:
+        record('batch', bench_batch(df, index))
+    if 'optimizer' in benchmarks:
+        record('optimizer', bench_optimizer(df))
+    if 'cleaning' in benchmarks:
+        record('cleaning', bench_cleaning(df, workdir))
+    return records
+
+
+def previous_run(path, commit):
+    # Latest recorded run made on a different commit, or None
+    try:
+        with open(path) as f:
+            runs = [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return None
+    runs = [run for run in runs if run.get('commit') != commit]
+    return runs[-1] if runs else None
+
+
+def compare(current, previous):
+    # Headline metric of every benchmark against the previous run
+    headline = {
+        'index': 'seconds', 'latency': 'median_ms', 'batch': 'cars_per_sec',
+        'optimizer': 'median_eval_ms', 'cleaning': 'rows_per_sec',
+    }
+    before = {(r['dataset'], r['benchmark']): r for r in previous['results']}
+    print(f"\n=== Compared with {previous.get('commit')} ({previous['timestamp']}) ===")
+    for result in current['results']:
+        old = before.get((result['dataset'], result['benchmark']))
+        metric = headline[result['benchmark']]
+        if old is None or not old.get(metric):
+            continue
+        ratio = result[metric] / old[metric]
+        print(f"  {result['dataset']:<10} {result['benchmark']:<10} {metric:<15} {old[metric]:>12.4g} -> {result[metric]:>12.4g}  (x{ratio:.2f})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the valuation engine on the real and on synthetic data sets.")
+    parser.add_argument('--sizes', type=int, nargs='*', default=SIZES, help="Synthetic data set sizes (none = real data only)")
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=BENCHMARKS, help="Benchmarks to run")
+    parser.add_argument('--seed', type=int, default=SEED, help="Seed of the synthetic data sets")
+    parser.add_argument('--output', default=RESULTS_FILE, help="JSON lines file the run is appended to")
+    parser.add_argument('--compare', action='store_true', help="Compare with the latest run recorded for another commit")
+    args = parser.parse_args()
+
+    real = load_clean_data(INPUT_FILE)
+    run = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'cpus': os.cpu_count(),
+        'seed': args.seed,
+        'results': [],
+    }
+
+    with tempfile.TemporaryDirectory() as workdir:
+        run['results'] += run_dataset('real', real, args.benchmarks, workdir)
+        for size in args.sizes:
+            run['results'] += run_dataset(f'synth-{size}', synthesize(real, size, args.seed), args.benchmarks, workdir)
+
+    previous = previous_run(args.output, run['commit']) if args.compare else None
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+    print(f"\nAppended results to {args.output}")
+    if previous is not None:
+        compare(run, previous)
+
+
+if __name__ == "__main__":
+    main()
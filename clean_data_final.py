@@ -1,23 +1,96 @@
+import argparse
+import gzip
+import io
+import os
+import tempfile
 import pandas as pd
 import json
 import numpy as np
 from datetime import datetime
 
 # Load Data
-input_file = 'auctions_latest_export.csv'
-output_file = 'tesla_final_clean.csv'
+INPUT_FILE = 'auctions_latest_export.csv'  # .gz / .zst archives work too (compression is inferred)
+OUTPUT_FILE = 'tesla_final_clean.csv'
+WIDGET_FILE = 'src/data/auctions.compact.json'
+QUARANTINE_FILE = 'tesla_quarantine.csv'  # Rows that fail validation (see validation_flags())
+CHUNK_SIZE = 50_000  # Export rows per chunk; bounds peak memory
+MODELS = ['Model 3', 'Model Y']
 
-df = pd.read_csv(input_file)
+# The only export columns the translation layer reads
+EXPORT_COLUMNS = [
+    'auction_id', 'model', 'variant', 'power_kw', 'first_registration',
+    'seller_type', 'taxation', 'accident_free_seller', 'accident_free_cardentity',
+    'tyres', 'trailer_hitch_seller', 'tesla_autopilot', 'heatpump',
+    'mileage', 'end_time', 'highest_bid_amount', 'status', 'number_of_bids',
+]
+# Pass-through columns keep their export text, so every chunk is written the
+# same way no matter which dtype pandas would infer for that chunk alone;
+# clean_export() then writes them the way the dtype of the whole export
+# (see text_kind()) would have
+EXPORT_DTYPES = {
+    'auction_id': str,
+    'mileage': str,
+    'number_of_bids': str,
+    'highest_bid_amount': str,
+}
+DATE_FORMATS = {
+    'first_registration': '%Y-%m-%d',
+    'end_time': '%Y-%m-%d %H:%M:%S',
+}
 
-# Filter for Tesla Model 3 and Model Y
-df = df[df['model'].isin(['Model 3', 'Model Y'])].copy()
+# Raw columns whose change makes an auction worth re-translating in
+# incremental mode (raw name -> cleaned name)
+CHANGE_COLUMNS = {
+    'status': 'status',
+    'highest_bid_amount': 'final_price',
+    'number_of_bids': 'number_of_bids',
+    'end_time': 'end_time',
+}
 
-# Helper Functions
+# Data-quality rules: translated rows failing any of them are kept out of the
+# cleaned file (they would be misleading comparables) and written to the
+# quarantine file instead, with the names of the failed rules
+PRICED_STATUSES = ['sold', 'closed_seller_accepted', 'closed_seller_declined']
+MAX_MILEAGE = 600_000
+MAX_AGE_MONTHS = 15 * 12  # The Model 3 was first registered in 2017
+VALIDATION_RULES = {
+    'unknown_variant': "power_kw missing or outside every variant's range",
+    'mileage': f"mileage missing, negative or above {MAX_MILEAGE:,} km",
+    'age': f"registration missing, after the auction or more than {MAX_AGE_MONTHS} months before it",
+    'tires': "tyres missing, not valid JSON or not a known tire set",
+    'price': f"no positive highest bid for status {', '.join(PRICED_STATUSES)}",
+}
+
+# Select & Rename Columns
+FINAL_COLUMNS = {
+    'auction_id': 'auction_id',
+    'model': 'model',
+    'variant_clean': 'variant_clean',
+    'is_highland': 'is_highland',
+    'tax_type': 'tax_type',
+    'is_accident_free': 'is_accident_free',
+    'tire_strategy': 'tire_strategy',
+    'has_hitch': 'has_hitch',
+    'autopilot': 'autopilot',
+    'has_heatpump': 'has_heatpump',
+    'mileage': 'mileage',
+    'age_at_auction_months': 'age_at_auction_months',
+    'first_registration': 'first_registration',
+    'end_time': 'end_time',
+    'highest_bid_amount': 'final_price',
+    'status': 'status',
+    'number_of_bids': 'number_of_bids',
+    'trust_tier': 'trust_tier'
+}
+
+# Row-by-row helpers. These are the reference definitions of the translation
+# layer; translate() uses the vectorized versions below and --check verifies
+# both produce byte-identical output.
 def determine_variant(row):
     model = row['model']
     kw = pd.to_numeric(row['power_kw'], errors='coerce')
     variant_str = str(row['variant'])
-    
+
     if model == 'Model 3':
         if 208 <= kw <= 239:
             return 'm3_sr'
@@ -34,8 +107,8 @@ def determine_variant(row):
              return 'my_lr'
         elif kw >= 390:
             return 'my_p'
-            
-    # Fallback to string matching if kw fails or as valid check? 
+
+    # Fallback to string matching if kw fails or as valid check?
     # Doc says "Power-based Clustering (Robust to naming changes)" so priority is KW.
     return 'unknown'
 
@@ -43,16 +116,18 @@ def is_highland(row):
     # 1. variant contains "Highland"
     if 'Highland' in str(row['variant']):
         return True
-    
+
     # 2. Model 3 AND Year >= 2024 AND kW in {235, 461}
     try:
         reg_year = pd.to_datetime(row['first_registration']).year
         kw = pd.to_numeric(row['power_kw'], errors='coerce')
         if row['model'] == 'Model 3' and reg_year >= 2024 and kw in [235, 461]:
             return True
-    except:
+    except (TypeError, ValueError):
+        # Unparseable registration: not Highland by year (validation_flags()
+        # quarantines the row for its age)
         pass
-    
+
     return False
 
 def determine_tax_type(row):
@@ -71,7 +146,8 @@ def parse_tires(json_str):
             if 'summer' in t_type: return '4_summer'
             if 'winter' in t_type: return '4_winter'
             if 'season' in t_type: return '4_all_season'
-    except:
+    except (TypeError, ValueError, AttributeError, KeyError):
+        # Missing or malformed JSON; 'unknown' rows are quarantined
         pass
     return 'unknown'
 
@@ -79,63 +155,450 @@ def determine_trust_tier(row):
     status = str(row['status'])
     bids = pd.to_numeric(row['number_of_bids'], errors='coerce')
     if pd.isna(bids): bids = 0
-    
+
     if status in ['sold', 'closed_seller_accepted']: # Assuming these map to Accepted
         return 'Tier 1'
     elif 'declined' in status and bids > 1:
         return 'Tier 2'
     elif 'declined' in status and bids <= 1:
         return 'Tier 3'
-    
+
     # Default for active/pending
-    return 'Tier 3' 
-
-# Apply Transformations
-df['variant_clean'] = df.apply(determine_variant, axis=1)
-df['is_highland'] = df.apply(is_highland, axis=1)
-df['tax_type'] = df.apply(determine_tax_type, axis=1)
-df['is_accident_free'] = (df['accident_free_seller'] == 't') & (df['accident_free_cardentity'] == 't')
-df['tire_strategy'] = df['tyres'].apply(parse_tires)
-df['has_hitch'] = df['trailer_hitch_seller'] == 't'
-df['autopilot'] = df['tesla_autopilot'].replace({
-    'Full self driving': 'FSD',
-    'Enhanced': 'EAP', 
-    'Standard': 'Standard'
-}).fillna('Standard')
-df['has_heatpump'] = df['heatpump'] == 't'
-
-# Dates & Age
-df['first_registration'] = pd.to_datetime(df['first_registration'])
-df['end_time'] = pd.to_datetime(df['end_time'], utc=True).dt.tz_localize(None)
-df['age_at_auction_months'] = ((df['end_time'] - df['first_registration']) / pd.Timedelta(days=30.44)).astype(int)
-
-# Trust Tier
-df['trust_tier'] = df.apply(determine_trust_tier, axis=1)
+    return 'Tier 3'
 
-# Select & Rename Columns
-final_cols = {
-    'auction_id': 'auction_id',
-    'model': 'model',
-    'variant_clean': 'variant_clean',
-    'is_highland': 'is_highland',
-    'tax_type': 'tax_type',
-    'is_accident_free': 'is_accident_free',
-    'tire_strategy': 'tire_strategy',
-    'has_hitch': 'has_hitch',
-    'autopilot': 'autopilot',
-    'has_heatpump': 'has_heatpump',
-    'mileage': 'mileage',
-    'age_at_auction_months': 'age_at_auction_months',
-    'first_registration': 'first_registration',
-    'end_time': 'end_time',
-    'highest_bid_amount': 'final_price',
-    'status': 'status',
-    'number_of_bids': 'number_of_bids',
-    'trust_tier': 'trust_tier'
-}
+# Vectorized translation layer: the same rules as whole-column operations
+def variant_column(df):
+    model = df['model'].to_numpy(dtype=object)
+    kw = pd.to_numeric(df['power_kw'], errors='coerce').to_numpy(dtype=np.float64)
+    m3 = model == 'Model 3'
+    my = model == 'Model Y'
+    # NaN kW fails every comparison and ends up 'unknown', as in the row version
+    with np.errstate(invalid='ignore'):
+        conditions = [
+            m3 & (208 <= kw) & (kw <= 239),
+            m3 & (324 <= kw) & (kw <= 366),
+            m3 & (377 <= kw),
+            my & (220 <= kw) & (kw <= 255),
+            my & (370 <= kw) & (kw <= 385),
+            my & (kw >= 390),
+        ]
+    return np.select(conditions, ['m3_sr', 'm3_lr', 'm3_p', 'my_sr', 'my_lr', 'my_p'], default='unknown')
+
+def parse_once(values, parse):
+    # Apply a scalar parser once per distinct value instead of once per row
+    codes, uniques = pd.factorize(values)
+    parsed = [parse(u) for u in uniques] + [parse(np.nan)]  # code -1 (missing) -> last slot
+    return np.array(parsed, dtype=object)[codes]
+
+def registration_year(first_registration):
+    # Year of each registration date, parsed like pd.to_datetime() on a single
+    # value; unparseable dates give NaN (the row version swallowed the error)
+    def year(value):
+        try:
+            return pd.to_datetime(value).year
+        except Exception:
+            return np.nan
+
+    codes, uniques = pd.factorize(first_registration)
+    uniques = pd.Series(uniques, dtype=object)
+    # Plain ISO dates (the export's format) parse as one array...
+    iso = uniques.astype(str).str.fullmatch(r'\d{4}-\d{2}-\d{2}')
+    years = pd.to_datetime(uniques.where(iso), format='%Y-%m-%d', errors='coerce').dt.year.to_numpy(dtype=np.float64, copy=True)
+    # ...anything else goes through the scalar parser, once per distinct value
+    for i in np.flatnonzero(np.isnan(years)):
+        years[i] = year(uniques[i])
+    return np.append(years, np.nan)[codes]
+
+def highland_column(df):
+    # 1. variant contains "Highland"
+    by_name = df['variant'].fillna('').astype(str).str.contains('Highland', regex=False).to_numpy(dtype=bool)
+
+    # 2. Model 3 AND Year >= 2024 AND kW in {235, 461}
+    kw = pd.to_numeric(df['power_kw'], errors='coerce')
+    with np.errstate(invalid='ignore'):
+        by_year = (
+            (df['model'].to_numpy(dtype=object) == 'Model 3') &
+            (registration_year(df['first_registration']) >= 2024) &
+            kw.isin([235, 461]).to_numpy()
+        )
+    return by_name | by_year
+
+def tax_type_column(df):
+    vat = (df['seller_type'] == 'company') | (df['taxation'] == 'vat_deductible')
+    return np.where(vat.to_numpy(dtype=bool), 'vat', 'margin')
+
+def tire_strategy_column(tyres):
+    return parse_once(tyres, parse_tires)
+
+def trust_tier_column(df):
+    status = df['status'].fillna('').astype(str)
+    bids = pd.to_numeric(df['number_of_bids'], errors='coerce').fillna(0)
+    accepted = status.isin(['sold', 'closed_seller_accepted']).to_numpy()
+    declined_with_bids = (status.str.contains('declined', regex=False) & (bids > 1)).to_numpy()
+    return np.select([accepted, declined_with_bids], ['Tier 1', 'Tier 2'], default='Tier 3')
+
+def translate(df, rowwise=False):
+    # Filter for Tesla Model 3 and Model Y
+    df = df[df['model'].isin(MODELS)].copy()
+
+    # Apply Transformations
+    if rowwise:
+        df['variant_clean'] = df.apply(determine_variant, axis=1)
+        df['is_highland'] = df.apply(is_highland, axis=1)
+        df['tax_type'] = df.apply(determine_tax_type, axis=1)
+        df['tire_strategy'] = df['tyres'].apply(parse_tires)
+    else:
+        df['variant_clean'] = variant_column(df)
+        df['is_highland'] = highland_column(df)
+        df['tax_type'] = tax_type_column(df)
+        df['tire_strategy'] = tire_strategy_column(df['tyres'])
+    df['is_accident_free'] = (df['accident_free_seller'] == 't') & (df['accident_free_cardentity'] == 't')
+    df['has_hitch'] = df['trailer_hitch_seller'] == 't'
+    df['autopilot'] = df['tesla_autopilot'].replace({
+        'Full self driving': 'FSD',
+        'Enhanced': 'EAP',
+        'Standard': 'Standard'
+    }).fillna('Standard')
+    df['has_heatpump'] = df['heatpump'] == 't'
+
+    # Dates & Age (missing or unparseable dates give a missing age, which
+    # validation_flags() quarantines)
+    df['first_registration'] = pd.to_datetime(df['first_registration'], errors='coerce')
+    df['end_time'] = pd.to_datetime(df['end_time'], utc=True, errors='coerce').dt.tz_localize(None)
+    age = (df['end_time'] - df['first_registration']) / pd.Timedelta(days=30.44)
+    df['age_at_auction_months'] = np.trunc(age).astype('Int64')
+
+    # Trust Tier
+    if rowwise:
+        df['trust_tier'] = df.apply(determine_trust_tier, axis=1)
+    else:
+        df['trust_tier'] = trust_tier_column(df)
+
+    return df[list(FINAL_COLUMNS.keys())].rename(columns=FINAL_COLUMNS)
+
+def numeric(values):
+    # Float array of a column; the plain cast is much faster than
+    # pd.to_numeric() on strings, which only handles columns with junk
+    try:
+        return values.to_numpy(dtype=np.float64, na_value=np.nan)
+    except (TypeError, ValueError):
+        return pd.to_numeric(values, errors='coerce').to_numpy(dtype=np.float64)
+
+def validation_flags(df_final):
+    # One boolean column per VALIDATION_RULES entry, True where a cleaned row
+    # fails the rule. Works on translated frames and on the all-string frames
+    # of incremental mode alike: every rule is a whole-column comparison.
+    mileage = numeric(df_final['mileage'])
+    age = numeric(df_final['age_at_auction_months'])
+    price = numeric(df_final['final_price'])
+    priced = df_final['status'].isin(PRICED_STATUSES).to_numpy()
+    # NaN fails every comparison, so `~(valid range)` flags missing values too
+    with np.errstate(invalid='ignore'):
+        flags = {
+            'unknown_variant': (df_final['variant_clean'] == 'unknown').to_numpy(),
+            'mileage': ~((mileage >= 0) & (mileage <= MAX_MILEAGE)),
+            'age': ~((age >= 0) & (age <= MAX_AGE_MONTHS)),
+            'tires': (df_final['tire_strategy'] == 'unknown').to_numpy(),
+            'price': priced & ~(price > 0),
+        }
+    return pd.DataFrame(flags, index=df_final.index)
+
+def split_valid(df_final):
+    # -> (rows passing every rule, failing rows with a failed_rules column,
+    #     failures per rule)
+    flags = validation_flags(df_final)
+    # Failed rules as a bit mask per row, named through a table of every combination
+    mask = flags.to_numpy() @ (1 << np.arange(len(flags.columns)))
+    failed = mask > 0
+    names = [';'.join(rule for bit, rule in enumerate(flags.columns) if combination >> bit & 1)
+             for combination in range(1 << len(flags.columns))]
+    quarantined = df_final[failed].copy()
+    quarantined['failed_rules'] = np.array(names, dtype=object)[mask[failed]]
+    return df_final[~failed], quarantined, flags.sum().to_dict()
+
+def read_export(path, chunksize=None):
+    # Only the columns the translation layer uses; compression (.gz, .zst) is
+    # inferred from the file name. With chunksize this yields DataFrames.
+    return pd.read_csv(path, usecols=EXPORT_COLUMNS, dtype=EXPORT_DTYPES, chunksize=chunksize, compression='infer')
+
+def csv_text(df_final, header=True):
+    # CSV text of translated rows with fixed date formats, so chunks written
+    # separately read exactly like one file written at once
+    df_final = df_final.copy()
+    for column, date_format in DATE_FORMATS.items():
+        df_final[column] = df_final[column].dt.strftime(date_format)
+    return df_final.to_csv(index=False, header=header)
+
+def text_kind(values, at_least='int'):
+    # dtype pd.read_csv() infers for a column of export text: 'int' without
+    # missing values, 'float' if numeric, 'object' otherwise. A whole file
+    # gets the widest kind of its chunks, so at_least short-cuts columns that
+    # are already known to be wider.
+    if at_least == 'object':
+        return 'object'
+    try:
+        numbers = values.to_numpy(dtype=np.float64, na_value=np.nan)
+    except (TypeError, ValueError):
+        return 'object'
+    if at_least == 'float' or np.isnan(numbers).any():
+        return 'float'
+    return 'int' if values.str.fullmatch(r'[+-]?\d+').all() else 'float'
+
+def format_passthrough(df_final, kinds):
+    # Pass-through columns typed like pd.read_csv() of the whole export types
+    # them (kinds: raw name -> text_kind()), so to_csv() writes the same text
+    # as the original script, e.g. '3.0' bids in a column with missing bids
+    df_final = df_final.copy()
+    for raw_name, kind in kinds.items():
+        column = FINAL_COLUMNS[raw_name]
+        if kind == 'int':
+            df_final[column] = pd.to_numeric(df_final[column], errors='coerce').astype('Int64')
+        elif kind == 'float':
+            df_final[column] = numeric(df_final[column])
+    return df_final
+
+def check_against_rowwise(input_path, chunksize=CHUNK_SIZE):
+    # Golden-output check: the streaming, vectorized pipeline must write exactly
+    # the bytes of the original script (one plain pd.read_csv() of the whole
+    # export, the row-by-row helpers, to_csv()) once quarantined rows are
+    # dropped, and for the export it was built from exactly the committed
+    # tesla_final_clean.csv. Returns True if every comparison is identical.
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, OUTPUT_FILE)
+        clean_export(input_path, path, chunksize=chunksize, quarantine_path=os.path.join(workdir, QUARANTINE_FILE))
+        with open(path, newline='') as f:
+            fast = f.read()
+    slow = split_valid(translate(pd.read_csv(input_path), rowwise=True))[0].to_csv(index=False)
+    identical = fast == slow
+    print(f"Streaming vs row-by-row baseline output: {'identical' if identical else 'DIFFERENT'}")
+    try:
+        with open(OUTPUT_FILE, newline='') as f:
+            committed = fast == f.read()
+    except FileNotFoundError:
+        pass
+    else:
+        print(f"Streaming vs current {OUTPUT_FILE}: {'identical' if committed else 'DIFFERENT'}")
+        identical &= committed
+    return identical
+
+def to_csv_text_frame(df_final):
+    # Cleaned rows exactly as they appear in the CSV (all strings), so rows kept
+    # from a previous run and freshly translated rows can be merged losslessly
+    return pd.read_csv(io.StringIO(csv_text(df_final)), dtype=str, keep_default_na=False)
+
+def change_keys(frame, columns):
+    # Normalized values of the change-tracking columns, indexed by auction_id.
+    # columns maps cleaned names to the column names used in `frame`.
+    keys = pd.DataFrame(index=frame['auction_id'].astype(str))
+    keys['status'] = frame[columns['status']].fillna('').astype(str).to_numpy()
+    keys['final_price'] = pd.to_numeric(frame[columns['final_price']], errors='coerce').to_numpy()
+    keys['number_of_bids'] = pd.to_numeric(frame[columns['number_of_bids']], errors='coerce').to_numpy()
+    end_time = pd.to_datetime(frame[columns['end_time']], utc=True, errors='coerce').dt.tz_localize(None)
+    keys['end_time'] = end_time.to_numpy()
+    return keys
+
+def incremental_translate(raw, previous, known, seen):
+    # Re-translate only auctions that are new or whose status, bid or end_time
+    # changed since the previous cleaned file; every other row is carried over
+    # verbatim, in export order. `known` is change_keys() of `previous` (unique
+    # ids), `seen` collects the ids of earlier chunks; repeated ids are always
+    # re-translated. Returns (cleaned text frame, counts).
+    current = change_keys(raw, {clean: raw_name for raw_name, clean in CHANGE_COLUMNS.items()})
+    ids = current.index
+    is_new = ~ids.isin(known.index)
+    aligned = known.reindex(ids[~ids.duplicated()]).reindex(ids)
+    differs = np.zeros(len(current), dtype=bool)
+    for column in current.columns:
+        a, b = current[column], aligned[column]
+        differs |= ~((a == b) | (a.isna() & b.isna())).to_numpy()
+    repeated = ids.duplicated(keep=False) | ids.isin(list(seen))
+    changed = is_new | differs | repeated
+    seen.update(ids)
+
+    positions = np.arange(len(raw))
+    parts = []
+    if changed.any():
+        parts.append(to_csv_text_frame(translate(raw[changed])).assign(_pos=positions[changed]))
+    if (~changed).any():
+        parts.append(previous.loc[ids[~changed]].reset_index(drop=True).assign(_pos=positions[~changed]))
+    merged = pd.concat(parts).sort_values('_pos', kind='stable').drop(columns='_pos')
+
+    counts = {
+        'inserted': int(is_new.sum()),
+        'updated': int((changed & ~is_new).sum()),
+        'unchanged': int((~changed).sum()),
+    }
+    return merged, counts
+
+def print_quarantine(quarantined, failures, path):
+    # Per-rule counts add up to more than the rows if a row fails several rules
+    print(f"Quarantined {quarantined} rows to {path}")
+    for rule, count in failures.items():
+        if count:
+            print(f"  {rule:<16} {count:>7}  {VALIDATION_RULES[rule]}")
+
+def clean_export(input_path, output_path, incremental=False, chunksize=CHUNK_SIZE, quarantine_path=QUARANTINE_FILE,
+                 kinds=None):
+    # Stream the export chunk by chunk: drop other models, translate (or, in
+    # incremental mode, merge with the previous output), validate, and append
+    # valid rows to the output and failing ones to the quarantine file. Both
+    # are written to temporary files and swapped in at the end. Returns the
+    # number of rows written to the output.
+    #
+    # Pass-through columns are written as the kinds seen so far; if a later
+    # chunk widens one after rows were written, the export is cleaned again
+    # with the final kinds (pass them as `kinds` to skip the inference).
+    infer = kinds is None
+    if infer:
+        kinds = dict.fromkeys(EXPORT_DTYPES, 'int')
+    widened = False
+    previous = None
+    if incremental and os.path.exists(output_path):
+        previous = pd.read_csv(output_path, dtype=str, keep_default_na=False)
+        if os.path.exists(quarantine_path):
+            # Quarantined rows are known too: unchanged ones are carried over
+            # (and quarantined again) instead of counting as inserted
+            rejected = pd.read_csv(quarantine_path, dtype=str, keep_default_na=False)
+            previous = pd.concat([previous, rejected.drop(columns='failed_rules')], ignore_index=True)
+        previous = previous.drop_duplicates('auction_id', keep='last').set_index('auction_id', drop=False)
+        known = change_keys(previous, {clean: clean for clean in CHANGE_COLUMNS.values()})
+        seen = set()
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+
+    rows = quarantined = 0
+    failures = dict.fromkeys(VALIDATION_RULES, 0)
+    tmp_path = output_path + '.tmp'
+    tmp_quarantine = quarantine_path + '.tmp'
+    with open(tmp_path, 'w', newline='') as out, open(tmp_quarantine, 'w', newline='') as side:
+        out.write(','.join(FINAL_COLUMNS.values()) + '\n')
+        side.write(','.join([*FINAL_COLUMNS.values(), 'failed_rules']) + '\n')
+        for chunk in read_export(input_path, chunksize):
+            if infer:
+                for raw_name, kind in kinds.items():
+                    wider = text_kind(chunk[raw_name], kind)
+                    widened |= wider != kind and rows + quarantined > 0
+                    kinds[raw_name] = wider
+            chunk = chunk[chunk['model'].isin(MODELS)]
+            if len(chunk) == 0:
+                continue
+            if previous is None:
+                valid, bad, chunk_failures = split_valid(format_passthrough(translate(chunk), kinds))
+                out.write(csv_text(valid, header=False))
+                side.write(csv_text(bad, header=False))
+            else:
+                merged, chunk_counts = incremental_translate(chunk, previous, known, seen)
+                valid, bad, chunk_failures = split_valid(format_passthrough(merged, kinds))
+                out.write(valid.to_csv(index=False, header=False))
+                side.write(bad.to_csv(index=False, header=False))
+                for label, count in chunk_counts.items():
+                    counts[label] += count
+            rows += len(valid)
+            quarantined += len(bad)
+            for rule, count in chunk_failures.items():
+                failures[rule] += count
+    if widened:
+        os.remove(tmp_path)
+        os.remove(tmp_quarantine)
+        return clean_export(input_path, output_path, incremental, chunksize, quarantine_path, kinds)
+    os.replace(tmp_path, output_path)
+    os.replace(tmp_quarantine, quarantine_path)
+
+    if previous is not None:
+        counts['removed'] = int((~previous.index.isin(list(seen))).sum())
+        print("Incremental update: " + ", ".join(f"{count} {label}" for label, count in counts.items()))
+    print_quarantine(quarantined, failures, quarantine_path)
+    return rows
+
+# Compact widget export (decoded by decodeAuctions() in src/utils/valuationAlgorithm.js).
+# Only rows the widget can use are kept: comparables (accident free, priced) and
+# the RECENT_CLOSED latest closed auctions its explore tables value. Rows are
+# grouped by cohort key, stored column-wise per group, categoricals as indexes
+# into `categories` (-1 = missing), dates as integers (days / seconds since 1970, UTC).
+WIDGET_FORMAT = 1
+RECENT_CLOSED = 20
+WIDGET_COHORT_KEY = ['model', 'variant_clean', 'is_highland', 'tax_type']
+WIDGET_CATEGORIES = ['tire_strategy', 'autopilot', 'status', 'trust_tier']
+WIDGET_FLAGS = ['is_accident_free', 'has_hitch', 'has_heatpump']
+
+def compact_number(value):
+    return int(value) if float(value).is_integer() else float(value)
+
+def compact_widget_data(df):
+    # df: cleaned rows as read from the CSV
+    priced = df['final_price'].notna()
+    comparable = df['is_accident_free'].astype(bool) & priced & (df['final_price'] > 0)
+    closed = df['status'].isin(['closed_seller_accepted', 'closed_seller_declined']) & priced
+    recent = df[closed].sort_values('end_time', ascending=False, kind='stable').index[:RECENT_CLOSED]
+    kept = df[comparable | df.index.isin(recent)].copy()
+    kept['row'] = np.arange(len(df))[(comparable | df.index.isin(recent)).to_numpy()]
+
+    categories = {column: sorted(kept[column].dropna().astype(str).unique()) for column in WIDGET_CATEGORIES}
+    end_time = pd.to_datetime(kept['end_time']).to_numpy().astype('datetime64[s]').astype(np.int64)
+    first_registration = pd.to_datetime(kept['first_registration']).to_numpy().astype('datetime64[D]').astype(np.int64)
+    columns = {
+        'row': kept['row'].tolist(),
+        'auction_id': kept['auction_id'].astype(str).tolist(),
+        **{flag: kept[flag].astype(bool).astype(int).tolist() for flag in WIDGET_FLAGS},
+        # Missing values get code -1
+        **{column: pd.Categorical(kept[column], categories=categories[column]).codes.tolist()
+           for column in WIDGET_CATEGORIES},
+        'mileage': kept['mileage'].astype(np.int64).tolist(),
+        'age_at_auction_months': kept['age_at_auction_months'].astype(np.int64).tolist(),
+        'first_registration': first_registration.tolist(),
+        'end_time': end_time.tolist(),
+        'final_price': [compact_number(v) for v in kept['final_price']],
+        'number_of_bids': pd.to_numeric(kept['number_of_bids'], errors='coerce').fillna(0).astype(np.int64).tolist(),
+    }
+    columns = pd.DataFrame(columns, index=kept.index)
+
+    cohorts = []
+    for key, group in kept.groupby(WIDGET_COHORT_KEY, sort=True).groups.items():
+        cohorts.append({
+            'key': [key[0], key[1], bool(key[2]), key[3]],
+            'columns': {name: values.tolist() for name, values in columns.loc[group].items()},
+        })
+    return {'format': WIDGET_FORMAT, 'rows': len(kept), 'categories': categories, 'cohorts': cohorts}
+
+def write_widget_json(clean_path, path=WIDGET_FILE, compress=()):
+    # Compact export for the React widget, plus optional .gz / .br copies
+    df = pd.read_csv(clean_path)
+    data = compact_widget_data(df)
+    text = json.dumps(data, separators=(',', ':'))
+    with open(path, 'w') as f:
+        f.write(text)
+    if 'gzip' in compress:
+        with open(path + '.gz', 'wb') as f:
+            f.write(gzip.compress(text.encode(), compresslevel=9, mtime=0))
+    if 'brotli' in compress:
+        try:
+            import brotli  # optional dependency, only needed for --compress brotli
+        except ImportError:
+            print(f"brotli is not installed, skipping {path}.br")
+        else:
+            with open(path + '.br', 'wb') as f:
+                f.write(brotli.compress(text.encode()))
+    return data['rows']
+
+def main():
+    parser = argparse.ArgumentParser(description="Translate the raw auction export into the cleaned valuation schema.")
+    parser.add_argument('--input', default=INPUT_FILE, help="Raw export (.csv, .csv.gz or .csv.zst)")
+    parser.add_argument('--chunksize', type=int, default=CHUNK_SIZE, help="Export rows read per chunk")
+    parser.add_argument('--check', action='store_true', help="Compare the streamed output with the original row-by-row script's output and exit")
+    parser.add_argument('--incremental', action='store_true', help=f"Only re-translate new or changed auctions and merge them into the existing {OUTPUT_FILE}")
+    parser.add_argument('--quarantine', default=QUARANTINE_FILE, help="CSV the rows failing validation are written to")
+    parser.add_argument('--compress', nargs='+', choices=['gzip', 'brotli'], default=[], help=f"Also write compressed copies of {WIDGET_FILE}")
+    args = parser.parse_args()
+
+    if args.check:
+        raise SystemExit(0 if check_against_rowwise(args.input, args.chunksize) else 1)
+
+    # Save
+    rows = clean_export(args.input, OUTPUT_FILE, incremental=args.incremental, chunksize=args.chunksize,
+                        quarantine_path=args.quarantine)
+    print(f"Successfully cleaned data. Saved {rows} rows to {OUTPUT_FILE}")
 
-df_final = df[list(final_cols.keys())].rename(columns=final_cols)
+    widget_rows = write_widget_json(OUTPUT_FILE, compress=args.compress)
+    print(f"Saved {widget_rows} widget auctions to {WIDGET_FILE}")
 
-# Save
-df_final.to_csv(output_file, index=False)
-print(f"Successfully cleaned data. Saved {len(df_final)} rows to {output_file}")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import profiler
+
+# Columnar cache of the cleaned data set (tesla_final_clean.csv).
+# The first load parses the CSV and writes one .npy file per column next to it
+# (tesla_final_clean.cache/); later loads memory-map those arrays instead of
+# re-parsing. Categoricals are stored as int codes, end_time as int64
+# nanoseconds, numerics with their native dtype. Worker processes that map the
+# same files share one copy through the page cache.
+# The cache is rebuilt automatically when the CSV's size, mtime or hash changes.
+
+CACHE_FORMAT = 1
+CATEGORY_MAX_SHARE = 0.5  # object columns with fewer distinct values than this share become categoricals
+
+
+def parse_clean_csv(csv_path):
+    # The uncached load (what load_data() used to do)
+    df = pd.read_csv(csv_path)
+    df['end_time'] = pd.to_datetime(df['end_time'])
+    # Ensure final_price is numeric
+    df['final_price'] = pd.to_numeric(df['final_price'], errors='coerce')
+    return df
+
+
+def cache_dir_for(csv_path):
+    return os.path.splitext(csv_path)[0] + '.cache'
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_stamp(csv_path):
+    stat = os.stat(csv_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def read_manifest(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get('format') == CACHE_FORMAT else None
+
+
+def write_manifest(cache_dir, manifest):
+    tmp_path = os.path.join(cache_dir, f'manifest.json.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, os.path.join(cache_dir, 'manifest.json'))
+
+
+def column_kind(series, name):
+    if name == 'end_time':
+        return 'datetime'
+    if pd.api.types.is_bool_dtype(series):
+        return 'bool'
+    if pd.api.types.is_integer_dtype(series):
+        return 'int'
+    if pd.api.types.is_float_dtype(series):
+        return 'float'
+    if series.notna().all() and series.nunique() < CATEGORY_MAX_SHARE * len(series):
+        return 'category'
+    return 'string'
+
+
+def code_dtype(n_categories):
+    # Smallest integer type (int16 at least) that holds every category code
+    for dtype in (np.int16, np.int32):
+        if n_categories <= np.iinfo(dtype).max + 1:
+            return dtype
+    return np.int64
+
+
+def encode_column(series, kind):
+    # -> (array to store, categories or None)
+    if kind == 'datetime':
+        return series.astype('datetime64[ns]').to_numpy().view(np.int64), None
+    if kind == 'category':
+        codes, categories = pd.factorize(series, sort=True)
+        return codes.astype(code_dtype(len(categories))), [str(c) for c in categories]
+    if kind == 'string':
+        return series.fillna('').astype(str).to_numpy(dtype=str), None
+    if kind == 'bool':
+        return series.to_numpy(dtype=bool), None
+    if kind == 'int':
+        return series.to_numpy(dtype=np.int64), None
+    return series.to_numpy(dtype=np.float64), None
+
+
+def decode_column(values, spec):
+    kind = spec['kind']
+    if kind == 'datetime':
+        return pd.Series(values.view('datetime64[ns]'), copy=False)
+    if kind == 'category':
+        return pd.Categorical.from_codes(values, categories=spec['categories'])
+    if kind == 'string':
+        return values.astype(object)
+    # Numerics and bools stay backed by the memory map
+    return values
+
+
+def build_cache(csv_path, cache_dir, sha256):
+    df = parse_clean_csv(csv_path)
+
+    data_dir = sha256[:16]
+    os.makedirs(os.path.join(cache_dir, data_dir), exist_ok=True)
+    columns = {}
+    for name in df.columns:
+        kind = column_kind(df[name], name)
+        values, categories = encode_column(df[name], kind)
+        # Written under a temporary name and renamed, so a process loading the
+        # same version meanwhile never maps a half-written array
+        path = os.path.join(cache_dir, data_dir, name + '.npy')
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, values)
+        os.replace(tmp_path, path)
+        columns[name] = {'kind': kind}
+        if categories is not None:
+            columns[name]['categories'] = categories
+
+    write_manifest(cache_dir, {
+        'format': CACHE_FORMAT,
+        'source': {**source_stamp(csv_path), 'sha256': sha256},
+        'rows': len(df),
+        'data_dir': data_dir,
+        'columns': columns,
+    })
+
+    # Drop arrays of older versions of the CSV
+    for entry in os.listdir(cache_dir):
+        if entry != data_dir and os.path.isdir(os.path.join(cache_dir, entry)):
+            shutil.rmtree(os.path.join(cache_dir, entry), ignore_errors=True)
+
+
+def ensure_cache(csv_path):
+    # Returns a manifest describing an up-to-date cache, rebuilding it if needed
+    cache_dir = cache_dir_for(csv_path)
+    manifest = read_manifest(cache_dir)
+    stamp = source_stamp(csv_path)
+    if manifest is not None:
+        source = manifest['source']
+        if source['size'] == stamp['size'] and source['mtime_ns'] == stamp['mtime_ns']:
+            profiler.count('dataset_cache_hit')
+            return manifest
+        # Touched but maybe not changed (git checkout, copy): compare contents
+        if source['sha256'] == file_sha256(csv_path):
+            manifest['source'].update(stamp)
+            write_manifest(cache_dir, manifest)
+            profiler.count('dataset_cache_hit')
+            return manifest
+
+    profiler.count('dataset_cache_miss')
+    os.makedirs(cache_dir, exist_ok=True)
+    build_cache(csv_path, cache_dir, file_sha256(csv_path))
+    return read_manifest(cache_dir)
+
+
+def load_clean_data(csv_path):
+    # Cleaned data set as a DataFrame, from the memory-mapped cache when possible.
+    # Falls back to parsing the CSV if the cache directory cannot be written.
+    try:
+        manifest = ensure_cache(csv_path)
+    except OSError as e:
+        print(f"Dataset cache unavailable ({e}), parsing {csv_path}")
+        return parse_clean_csv(csv_path)
+
+    data_dir = os.path.join(cache_dir_for(csv_path), manifest['data_dir'])
+    columns = {}
+    for name, spec in manifest['columns'].items():
+        values = np.load(os.path.join(data_dir, name + '.npy'), mmap_mode='r')
+        columns[name] = decode_column(values, spec)
+    df = pd.DataFrame(columns, copy=False)
+    df.attrs['source_sha256'] = manifest['source']['sha256']
+    return df
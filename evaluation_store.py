@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+import sqlite3
+from datetime import datetime, timezone
+
+import pandas as pd
+
+# Persistent record of optimizer evaluations (SQLite, standard library only).
+# An evaluation is stored under (dataset fingerprint, validation set key,
+# weights), so re-running a search skips every candidate already scored on the
+# same data and targets: an interrupted run resumes where it stopped, and
+# overlapping runs share work. Every run is logged too, and the tables can be
+# queried afterwards (optimize_algo.py --history, or any SQLite client):
+#
+#   runs         id, search, seed, iterations, dataset, validation, started_at,
+#                finished_at (NULL if interrupted), best_error
+#   validations  key, definition (JSON: targets, price adjustments, subset)
+#   evaluations  dataset, validation, weights (JSON), error, run_id, created_at
+
+STORE_FILE = 'optimizer_trials.sqlite'
+COMMIT_EVERY = 100  # New evaluations buffered before a commit
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    search TEXT,
+    seed INTEGER,
+    iterations INTEGER,
+    dataset TEXT NOT NULL,
+    validation TEXT NOT NULL,
+    started_at TEXT NOT NULL,
+    finished_at TEXT,
+    best_error REAL
+);
+CREATE TABLE IF NOT EXISTS validations (
+    key TEXT PRIMARY KEY,
+    definition TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS evaluations (
+    dataset TEXT NOT NULL,
+    validation TEXT NOT NULL,
+    weights TEXT NOT NULL,
+    error REAL NOT NULL,
+    run_id INTEGER REFERENCES runs(id),
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (dataset, validation, weights)
+);
+"""
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+
+def plain(weights):
+    # NumPy scalars -> Python numbers, for JSON
+    return {k: v.item() if hasattr(v, 'item') else v for k, v in weights.items()}
+
+
+def weights_key(weights):
+    # Canonical JSON of a weight set; float repr round-trips exactly
+    return json.dumps(plain(weights), sort_keys=True)
+
+
+def validation_key(definition):
+    return hashlib.sha256(json.dumps(definition, sort_keys=True).encode()).hexdigest()
+
+
+class Trials:
+    # Evaluations of one (dataset, validation set) scope, loaded up front
+    def __init__(self, store, dataset, validation, run_id=None):
+        self.store = store
+        self.dataset = dataset
+        self.validation = validation
+        self.key = store.add_validation(validation)
+        self.run_id = run_id
+        self.errors = store.errors(dataset, self.key)
+
+    def with_validation(self, validation):
+        # Same run and dataset, another validation set (e.g. a subset of targets)
+        return Trials(self.store, self.dataset, validation, self.run_id)
+
+    def get(self, weights):
+        return self.errors.get(weights_key(weights))
+
+    def put(self, weights, error):
+        key = weights_key(weights)
+        if key not in self.errors:
+            self.errors[key] = float(error)
+            self.store.add_evaluation(self.dataset, self.key, key, float(error), self.run_id)
+
+    def __len__(self):
+        return len(self.errors)
+
+
+class EvaluationStore:
+    def __init__(self, path=STORE_FILE):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        self.pending = 0
+
+    def add_validation(self, definition):
+        key = validation_key(definition)
+        self.connection.execute(
+            'INSERT OR IGNORE INTO validations (key, definition) VALUES (?, ?)',
+            (key, json.dumps(definition, sort_keys=True)),
+        )
+        return key
+
+    def errors(self, dataset, validation):
+        # {weights JSON: error} of every stored evaluation in the scope
+        rows = self.connection.execute(
+            'SELECT weights, error FROM evaluations WHERE dataset = ? AND validation = ?', (dataset, validation))
+        return dict(rows)
+
+    def add_evaluation(self, dataset, validation, weights, error, run_id):
+        self.connection.execute(
+            'INSERT OR IGNORE INTO evaluations (dataset, validation, weights, error, run_id, created_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (dataset, validation, weights, error, run_id, now()),
+        )
+        self.pending += 1
+        if self.pending >= COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+    def start_run(self, dataset, validation, search, seed, iterations):
+        # -> Trials of the new run
+        cursor = self.connection.execute(
+            'INSERT INTO runs (search, seed, iterations, dataset, validation, started_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (search, seed, iterations, dataset, validation_key(validation), now()),
+        )
+        self.commit()
+        return Trials(self, dataset, validation, cursor.lastrowid)
+
+    def finish_run(self, run_id, best_error):
+        self.connection.execute(
+            'UPDATE runs SET finished_at = ?, best_error = ? WHERE id = ?', (now(), float(best_error), run_id))
+        self.commit()
+
+    def history(self, dataset=None, validation=None, limit=20):
+        # Best stored evaluations (optionally of one scope), weights expanded
+        # into one column per parameter
+        query = 'SELECT dataset, validation, run_id, created_at, error, weights FROM evaluations'
+        conditions, params = [], []
+        if dataset is not None:
+            conditions.append('dataset = ?')
+            params.append(dataset)
+        if validation is not None:
+            conditions.append('validation = ?')
+            params.append(validation_key(validation))
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY error, created_at LIMIT ?'
+        trials = pd.read_sql_query(query, self.connection, params=params + [limit])
+        weights = pd.DataFrame([json.loads(w) for w in trials.pop('weights')], index=trials.index)
+        return pd.concat([trials, weights], axis=1)
+
+    def runs(self):
+        return pd.read_sql_query('SELECT * FROM runs ORDER BY id', self.connection)
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+def write_params(path, weights, error=None, **metadata):
+    # Best parameters as JSON ({"weights": {...}, "error": ..., ...}),
+    # readable by validate_algo.py --params
+    document = {'weights': plain(weights), 'error': None if error is None else float(error),
+                **metadata, 'written_at': now()}
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(document, f, indent=2)
+        f.write('\n')
+    os.replace(tmp_path, path)
+
+
+def read_params(path):
+    with open(path) as f:
+        return json.load(f)['weights']
@@ -0,0 +1,142 @@
+import json
+import marshal
+import time
+from contextlib import nullcontext
+
+# Optional stage timers and counters for the valuation hot paths.
+#
+#     with profiler.stage('distance'):
+#         ...
+#     profiler.count('candidates_scored', n)
+#     profiler.observe('cohort_size', n)
+#
+# Disabled (the default), stage() hands back one shared no-op context manager
+# and count()/observe() return immediately, so instrumented code runs at its
+# normal speed. enable() starts recording; write() exports a JSON summary or a
+# cProfile/pstats-compatible file (open it with `python -m pstats` or snakeviz).
+# Stages nest: a stage's own time excludes the stages opened inside it.
+
+NULL_STAGE = nullcontext()
+
+
+class Stage:
+    __slots__ = ('profiler', 'name', 'started', 'child_time')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.child_time = 0.0
+        self.profiler.stack.append(self)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        stack = self.profiler.stack
+        stack.pop()
+        parent = stack[-1].name if stack else None
+        if stack:
+            stack[-1].child_time += elapsed
+
+        entry = self.profiler.stages.setdefault(self.name, {'calls': 0, 'total': 0.0, 'own': 0.0, 'callers': {}})
+        entry['calls'] += 1
+        entry['total'] += elapsed
+        entry['own'] += elapsed - self.child_time
+        caller = entry['callers'].setdefault(parent, [0, 0.0, 0.0])
+        caller[0] += 1
+        caller[1] += elapsed - self.child_time
+        caller[2] += elapsed
+        return False
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.counters = {}
+        self.observations = {}
+        self.stack = []
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def stage(self, name):
+        return Stage(self, name) if self.enabled else NULL_STAGE
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        # Running count / sum / min / max of a per-call quantity (e.g. cohort size)
+        if not self.enabled:
+            return
+        stats = self.observations.get(name)
+        if stats is None:
+            self.observations[name] = {'count': 1, 'sum': value, 'min': value, 'max': value}
+        else:
+            stats['count'] += 1
+            stats['sum'] += value
+            stats['min'] = min(stats['min'], value)
+            stats['max'] = max(stats['max'], value)
+
+    def summary(self):
+        stages = {
+            name: {
+                'calls': entry['calls'],
+                'total_ms': entry['total'] * 1e3,
+                'own_ms': entry['own'] * 1e3,
+                'mean_us': entry['total'] / entry['calls'] * 1e6,
+            }
+            for name, entry in sorted(self.stages.items(), key=lambda item: -item[1]['total'])
+        }
+        observations = {
+            name: {**stats, 'mean': stats['sum'] / stats['count']}
+            for name, stats in self.observations.items()
+        }
+        return {'stages': stages, 'counters': dict(self.counters), 'observations': observations}
+
+    def pstats_dict(self):
+        # Stage timings in the layout cProfile's dump_stats() writes:
+        # {(file, line, name): (primitive calls, calls, own time, total time, callers)}
+        def key(name):
+            return ('<stage>', 0, name)
+
+        stats = {}
+        for name, entry in self.stages.items():
+            callers = {
+                key(parent): (calls, calls, own, total)
+                for parent, (calls, own, total) in entry['callers'].items() if parent is not None
+            }
+            stats[key(name)] = (entry['calls'], entry['calls'], entry['own'], entry['total'], callers)
+        return stats
+
+    def write(self, path):
+        # .json -> summary(), anything else -> pstats-compatible binary dump
+        if path.endswith('.json'):
+            with open(path, 'w') as f:
+                json.dump(self.summary(), f, indent=2)
+        else:
+            with open(path, 'wb') as f:
+                marshal.dump(self.pstats_dict(), f)
+
+    def report(self):
+        summary = self.summary()
+        print("\n=== PROFILE ===")
+        for name, stats in summary['stages'].items():
+            print(f"  {name:<20} {stats['calls']:>8} calls  {stats['total_ms']:>10.2f} ms total  {stats['own_ms']:>10.2f} ms own")
+        for name, value in summary['counters'].items():
+            print(f"  {name:<20} {value}")
+        for name, stats in summary['observations'].items():
+            print(f"  {name:<20} mean {stats['mean']:.1f}  min {stats['min']}  max {stats['max']}  (n={stats['count']})")
+
+
+profiler = Profiler()
@@ -1,13 +1,31 @@
+import argparse
+import contextlib
+import itertools
+import multiprocessing as mp
+import os
 import pandas as pd
 import numpy as np
-import random
 import copy
 from datetime import datetime
 
+from dataset_cache import load_clean_data
+from evaluation_store import STORE_FILE, EvaluationStore, validation_key, write_params
+from instrumentation import profiler
+from valuation_engine import (
+    PRICE_ADJUSTMENTS, CohortIndex, add_feature_codes, build_feature_deltas, predict_from_deltas, select_targets,
+)
+
 # Configuration
 INPUT_FILE = 'tesla_final_clean.csv'
 VALIDATION_SIZE = 50  # Number of recent "Gold/Silver" cars to test against
 ITERATIONS = 300       # Number of random weight combinations to try
+SEED = 42              # Candidate i is drawn from its own stream (SEED, i)
+WORKERS = 1            # Worker processes for candidate evaluation (1 = in-process)
+SEARCH = 'random'      # Search strategy, see SEARCH_STRATEGIES
+HALVING_ETA = 3        # Successive halving: promote the best 1/ETA of each rung
+HALVING_RUNGS = 3      # ... on 1/ETA^2, 1/ETA and finally all of the validation set
+STORE_CHUNK = 1024     # Candidates looked up in the evaluation store at a time
+PARAMS_FILE = 'optimized_params.json'  # Best weights of the last run (validate_algo.py --params)
 
 # Base Weights (Starting Point)
 BASE_WEIGHTS = {
@@ -36,6 +54,7 @@ PARAM_RANGES = {
     'RECENCY_PENALTY_PER_DAY': (0.05, 0.5),
     'TIRE_MISMATCH_8_VS_4': (30.0, 60.0),
     'TIRE_MISMATCH_4_VS_8': (10.0, 30.0),
+    'TIRE_TYPE_MISMATCH': (5.0, 30.0),
     'HEAT_PUMP_MISMATCH': (30.0, 80.0),
     'AUTOPILOT_MISMATCH': (20.0, 60.0),
     'TRUST_TIER_2_PENALTY': (20.0, 60.0),
@@ -44,20 +63,13 @@ PARAM_RANGES = {
     'IDW_POWER': (2.0, 5.0)
 }
 
-# Price Adjustments (Fixed for now, or could optimize)
-PRICE_ADJUSTMENTS = {
-    'M3_MILEAGE_ADJ_PER_KM': 0.05,
-    'MY_MILEAGE_ADJ_PER_KM': 0.08,
-    'HITCH_ADJ': 250
-}
-
 def load_data():
-    df = pd.read_csv(INPUT_FILE)
-    df['end_time'] = pd.to_datetime(df['end_time'])
-    df['final_price'] = pd.to_numeric(df['final_price'], errors='coerce')
+    # Parsed, typed columns from the columnar cache next to the CSV
+    df = load_clean_data(INPUT_FILE)
     # Filter out bad data
     df = df[df['final_price'].notna()].copy()
-    return df
+    # Integer codes for the distance kernel
+    return add_feature_codes(df)
 
 def get_validation_set(df, n=50):
     # Definition of "High Confidence" for VALIDATION targets
@@ -80,113 +92,203 @@ def get_validation_set(df, n=50):
     # Sort by recent
     return valid_targets.sort_values('end_time', ascending=False).head(n)
 
-def calculate_distance(target, candidate, weights):
-    score = 0
-    
-    # Mileage
-    mileage_diff = abs(target['mileage'] - candidate['mileage'])
-    if target['model'] == 'Model 3':
-        score += mileage_diff * weights['M3_MILEAGE_PENALTY_PER_KM']
-    else:
-        score += mileage_diff * weights['MY_MILEAGE_PENALTY_PER_KM']
-        
-    # Age
-    age_diff = abs(target['age_at_auction_months'] - candidate['age_at_auction_months'])
-    if target['model'] == 'Model 3':
-        score += age_diff * weights['M3_AGE_PENALTY_PER_MONTH']
-    else:
-        score += age_diff * weights['MY_AGE_PENALTY_PER_MONTH']
-        
-    # Recency
-    days_diff = max(0, (target['end_time'] - candidate['end_time']).days)
-    score += days_diff * weights['RECENCY_PENALTY_PER_DAY']
-    
-    # Tire
-    t = target['tire_strategy']
-    c = candidate['tire_strategy']
-    if t == '8_tires' and c != '8_tires': score += weights['TIRE_MISMATCH_8_VS_4']
-    elif t != '8_tires' and c == '8_tires': score += weights['TIRE_MISMATCH_4_VS_8']
-    elif t != c: score += weights['TIRE_TYPE_MISMATCH']
-        
-    # Features
-    if target['has_heatpump'] != candidate['has_heatpump']: score += weights['HEAT_PUMP_MISMATCH']
-    if target['autopilot'] != candidate['autopilot']: score += weights['AUTOPILOT_MISMATCH']
-    
-    # Trust Tier
-    tier = candidate['trust_tier']
-    if tier == 'Tier 2': score += weights['TRUST_TIER_2_PENALTY']
-    elif tier == 'Tier 3': score += weights['TRUST_TIER_3_PENALTY']
-    
-    return score
-
-def predict(target, data, weights):
-    # Cohort Filter
-    cohort = data[
-        (data['model'] == target['model']) &
-        (data['variant_clean'] == target['variant_clean']) &
-        (data['is_highland'] == target['is_highland']) &
-        (data['tax_type'] == target['tax_type']) &
-        (data['is_accident_free'] == True) &
-        (data['end_time'] < target['end_time']) &
-        (data['auction_id'] != target['auction_id'])
-    ].copy()
-    
-    if len(cohort) == 0: return None
-    
-    # Distance
-    cohort['distance'] = cohort.apply(lambda row: calculate_distance(target, row, weights), axis=1)
-    
-    # Top K
-    k = int(weights['K_NEIGHBORS'])
-    neighbors = cohort.sort_values('distance').head(k)
-    
-    if len(neighbors) == 0: return None
-    
-    # Weighting
-    epsilon = 1e-6
-    neighbors['weight'] = 1 / ((neighbors['distance'] + epsilon) ** weights['IDW_POWER'])
-    
-    # Price adjust
-    neighbors['adjusted_price'] = neighbors['final_price'] # Simple start
-    # Apply mileage adj
-    for idx, n_row in neighbors.iterrows():
-        m_delta = n_row['mileage'] - target['mileage']
-        rate = PRICE_ADJUSTMENTS['M3_MILEAGE_ADJ_PER_KM'] if target['model'] == 'Model 3' else PRICE_ADJUSTMENTS['MY_MILEAGE_ADJ_PER_KM']
-        neighbors.at[idx, 'adjusted_price'] += (m_delta * rate)
-        
-        # Hitch adj
-        if target['has_hitch'] and not n_row['has_hitch']: neighbors.at[idx, 'adjusted_price'] += PRICE_ADJUSTMENTS['HITCH_ADJ']
-        elif not target['has_hitch'] and n_row['has_hitch']: neighbors.at[idx, 'adjusted_price'] -= PRICE_ADJUSTMENTS['HITCH_ADJ']
-
-    # Final
-    total_w = neighbors['weight'].sum()
-    pred = (neighbors['adjusted_price'] * neighbors['weight']).sum() / total_w
-    
-    return pred
+def validation_definition(val_set):
+    # Everything the validation error depends on besides the comparables and
+    # the weights (keys the evaluation store together with the data set)
+    return {
+        'auction_ids': val_set['auction_id'].astype(str).tolist(),
+        'actual': val_set['final_price'].astype(float).tolist(),
+        'price_adjustments': PRICE_ADJUSTMENTS,
+        'stride': 1,
+    }
 
-def evaluate_weights(weights, validation_set, full_data):
-    errors = []
+def evaluate_weights(weights, deltas):
+    # deltas: build_feature_deltas() of the validation set. Cohorts, raw
+    # differences and adjusted prices are fixed across iterations, so only the
+    # scoring with these weights is left to do.
+    preds = predict_from_deltas(deltas, weights)
+    actual = deltas['actual']
+    profiler.count('evaluations')
     
-    for _, target in validation_set.iterrows():
-        pred = predict(target, full_data, weights)
-        if pred:
-            actual = target['final_price']
-            error_pct = abs(pred - actual) / actual
-            errors.append(error_pct)
-            
-    if not errors: return 1.0 # 100% error default
-    return np.mean(errors)
+    with profiler.stage('error'):
+        # Skip targets without a prediction (no comparables)
+        valid = ~np.isnan(preds) & (preds != 0)
+        if not valid.any(): return 1.0 # 100% error default
+        
+        errors = np.abs(preds[valid] - actual[valid]) / actual[valid]
+        return np.mean(errors)
 
-def generate_random_weights():
+def generate_random_weights(rng=None):
+    rng = rng if rng is not None else np.random.default_rng()
     w = BASE_WEIGHTS.copy()
     for k, v in PARAM_RANGES.items():
         if isinstance(v[0], int):
-            w[k] = random.randint(v[0], v[1])
+            w[k] = int(rng.integers(v[0], v[1] + 1))
         else:
-            w[k] = random.uniform(v[0], v[1])
+            w[k] = float(rng.uniform(v[0], v[1]))
     return w
 
+def candidate_weights_stream(n, seed=SEED):
+    # Candidate i only depends on (seed, i), so a run is reproducible no matter
+    # how many workers evaluate it or in which order they finish.
+    for i in range(n):
+        yield i, generate_random_weights(np.random.default_rng([seed, i]))
+
+# Read-only state of a worker process. With the 'fork' start method the parent
+# fills it before the pool starts and workers inherit the arrays copy-on-write;
+# nothing but (i, weights, stride) is pickled per task.
+_worker_state = {}
+
+def _init_worker(deltas):
+    _worker_state['deltas'] = {1: deltas}
+
+def _evaluate_candidate(task):
+    i, weights, stride = task
+    subsets = _worker_state['deltas']
+    if stride not in subsets:
+        subsets[stride] = select_targets(subsets[1], slice(None, None, stride))
+    return i, weights, evaluate_weights(weights, subsets[stride])
+
+def open_pool(deltas, workers=WORKERS):
+    # Worker pool for a whole search (None = evaluate in-process). Workers hold
+    # the full deltas; subsets for successive halving are cut once per worker.
+    if workers <= 1:
+        return None
+    _init_worker(deltas)
+    if 'fork' in mp.get_all_start_methods():
+        return mp.get_context('fork').Pool(workers)
+    # No fork (Windows/macOS spawn): ship the data once per worker, not per task
+    return mp.get_context('spawn').Pool(workers, initializer=_init_worker, initargs=(deltas,))
+
+def evaluate_candidates(candidates, deltas, pool=None, trials=None, stride=1):
+    # Yields (i, weights, error) in candidate order, in-process or on `pool`
+    # (see open_pool()), scored on every stride-th validation target of
+    # `deltas`. With trials (evaluation_store.Trials), stored errors are reused
+    # and only the remaining candidates are evaluated; new errors are stored.
+    if trials is not None:
+        candidates = iter(candidates)
+        while chunk := list(itertools.islice(candidates, STORE_CHUNK)):
+            known = [trials.get(weights) for _, weights in chunk]
+            fresh = evaluate_candidates(
+                [candidate for candidate, error in zip(chunk, known) if error is None], deltas, pool, stride=stride)
+            for (i, weights), error in zip(chunk, known):
+                if error is None:
+                    _, _, error = next(fresh)
+                    trials.put(weights, error)
+                else:
+                    profiler.count('evaluations_stored')
+                yield i, weights, error
+        return
+
+    if pool is None:
+        subset = deltas if stride == 1 else select_targets(deltas, slice(None, None, stride))
+        for i, weights in candidates:
+            yield i, weights, evaluate_weights(weights, subset)
+        return
+    tasks = ((i, weights, stride) for i, weights in candidates)
+    yield from pool.imap(_evaluate_candidate, tasks, chunksize=16)
+
+def report_best(label, error):
+    print(f"New Best! {label}: {error*100:.2f}%")
+
+def random_search(best_weights, best_error, deltas, iterations, seed, pool=None, trials=None):
+    # Independent uniform draws from PARAM_RANGES
+    candidates = candidate_weights_stream(iterations, seed)
+    for i, candidate_weights, error in evaluate_candidates(candidates, deltas, pool, trials):
+        if error < best_error:
+            best_error = error
+            best_weights = candidate_weights
+            report_best(f"Iter {i}", best_error)
+    return best_weights, best_error, iterations
+
+def coordinate_descent(best_weights, best_error, deltas, iterations, seed, pool=None, trials=None):
+    # Line search along one parameter at a time around the current best. Each
+    # parameter tries 4 offsets of +-1 and +-2 steps (a step starts at 1/8 of its
+    # range); a full sweep without improvement halves the step.
+    step = 0.125
+    evals = 0
+    while evals < iterations and step > 1e-3:
+        improved = False
+        for k, (lo, hi) in PARAM_RANGES.items():
+            values = []
+            for offset in (-2, -1, 1, 2):
+                v = min(max(best_weights[k] + offset * step * (hi - lo), lo), hi)
+                v = int(round(v)) if isinstance(lo, int) else v
+                if v != best_weights[k] and v not in values:
+                    values.append(v)
+            candidates = [(evals + j, {**best_weights, k: v}) for j, v in enumerate(values)]
+            evals += len(candidates)
+            for i, candidate_weights, error in evaluate_candidates(candidates, deltas, pool, trials):
+                if error < best_error:
+                    best_error = error
+                    best_weights = candidate_weights
+                    improved = True
+                    report_best(f"Eval {i} ({k})", best_error)
+            if evals >= iterations:
+                break
+        if not improved:
+            step /= 2
+    return best_weights, best_error, evals
+
+def successive_halving(best_weights, best_error, deltas, iterations, seed, pool=None, trials=None):
+    # Draws the same candidates as random search, but rung r scores them on
+    # every ETA^(RUNGS-1-r)-th validation target only (spread across time) and
+    # promotes the best 1/ETA. Only the last rung runs on the full set.
+    candidates = list(candidate_weights_stream(iterations, seed))
+    full_evals = 0
+    for rung in range(HALVING_RUNGS):
+        stride = HALVING_ETA ** (HALVING_RUNGS - 1 - rung)
+        rung_trials = trials.with_validation({**trials.validation, 'stride': stride}) if trials is not None else None
+        scored = list(evaluate_candidates(candidates, deltas, pool, rung_trials, stride))
+        print(f"Rung {rung}: {len(candidates)} candidates on {len(deltas['actual'][::stride])} targets")
+        if stride == 1:
+            full_evals += len(scored)
+            break
+        scored.sort(key=lambda result: (result[2], result[0]))
+        keep = max(1, len(scored) // HALVING_ETA)
+        candidates = [(i, w) for i, w, _ in scored[:keep]]
+    
+    for i, candidate_weights, error in scored:
+        if error < best_error:
+            best_error = error
+            best_weights = candidate_weights
+            report_best(f"Candidate {i}", best_error)
+    return best_weights, best_error, full_evals
+
+SEARCH_STRATEGIES = {
+    'random': random_search,
+    'coordinate': coordinate_descent,
+    'halving': successive_halving,
+}
+
+def print_history(store, index, validation, limit):
+    runs = store.runs()
+    print(f"=== RUNS ({len(runs)}) ===")
+    if len(runs):
+        print(runs.to_string(index=False, columns=['id', 'search', 'seed', 'iterations', 'started_at', 'finished_at', 'best_error']))
+    trials = store.history(index.fingerprint, validation, limit)
+    print(f"\n=== BEST {len(trials)} EVALUATIONS (current data and validation set) ===")
+    if len(trials):
+        trials = trials.drop(columns=['dataset', 'validation'])
+        trials['error'] = trials['error'].map(lambda e: f"{e*100:.2f}%")
+        print(trials.to_string(index=False))
+
 def main():
+    parser = argparse.ArgumentParser(description="Search the distance weights.")
+    parser.add_argument('--search', choices=sorted(SEARCH_STRATEGIES), default=SEARCH, help="Search strategy")
+    parser.add_argument('--iterations', type=int, default=ITERATIONS, help="Candidates to draw (random, halving) or evaluations to spend (coordinate)")
+    parser.add_argument('--workers', type=int, default=WORKERS, help=f"Worker processes (0 = all {os.cpu_count()} cores)")
+    parser.add_argument('--seed', type=int, default=SEED, help="Seed of the candidate streams")
+    parser.add_argument('--store', default=STORE_FILE, help="SQLite evaluation store; stored candidates are not re-evaluated")
+    parser.add_argument('--no-store', action='store_true', help="Evaluate everything and keep results in memory only")
+    parser.add_argument('--history', type=int, nargs='?', const=20, metavar='N', help="Show past runs and the N best stored evaluations, then exit")
+    parser.add_argument('--output', default=PARAMS_FILE, help="JSON file the best weights are written to")
+    parser.add_argument('--profile', metavar='PATH', help="Record stage timings and counters of this process (not of pool workers); write them to PATH (.json summary, otherwise pstats)")
+    args = parser.parse_args()
+    workers = args.workers or os.cpu_count()
+    if args.profile:
+        profiler.enable()
+    
     print(f"Loading Data...")
     df = load_data()
     
@@ -194,32 +296,64 @@ def main():
     val_set = get_validation_set(df, n=VALIDATION_SIZE)
     print(f"Validation Set Size: {len(val_set)}")
     
-    print(f"Running Baseline...")
-    base_error = evaluate_weights(BASE_WEIGHTS, val_set, df)
-    print(f"Baseline Mean Absolute Error: {base_error*100:.2f}%")
+    index = CohortIndex(df)
+    validation = validation_definition(val_set)
+    store = None if args.no_store else EvaluationStore(args.store)
+    if args.history is not None:
+        if store is None:
+            parser.error("--history needs the evaluation store")
+        print_history(store, index, validation, args.history)
+        store.close()
+        return
+    
+    # Hard filters and all weight-independent differences are computed once;
+    # every evaluation only rescores them
+    deltas = build_feature_deltas(val_set, index, PRICE_ADJUSTMENTS)
     
-    best_weights = BASE_WEIGHTS.copy()
-    best_error = base_error
+    trials = None
+    if store is not None:
+        trials = store.start_run(index.fingerprint, validation, args.search, args.seed, args.iterations)
+        print(f"Evaluation store {args.store}: {len(trials)} stored evaluation(s) for this data and validation set")
     
-    print(f"Starting optimization ({ITERATIONS} iterations)...")
-    for i in range(ITERATIONS):
-        candidate_weights = generate_random_weights()
-        error = evaluate_weights(candidate_weights, val_set, df)
+    try:
+        print(f"Running Baseline...")
+        base_error = trials.get(BASE_WEIGHTS) if trials is not None else None
+        if base_error is None:
+            base_error = evaluate_weights(BASE_WEIGHTS, deltas)
+            if trials is not None:
+                trials.put(BASE_WEIGHTS, base_error)
+        print(f"Baseline Mean Absolute Error: {base_error*100:.2f}%")
         
-        if error < best_error:
-            best_error = error
-            best_weights = candidate_weights
-            print(f"New Best! Iter {i}: {best_error*100:.2f}%")
+        print(f"Starting optimization ({args.search} search, {args.iterations} iterations, {workers} worker(s))...")
+        search = SEARCH_STRATEGIES[args.search]
+        # One pool for the whole search; searches evaluate many small batches
+        pool = open_pool(deltas, workers)
+        with pool or contextlib.nullcontext():
+            best_weights, best_error, full_evals = search(
+                BASE_WEIGHTS.copy(), base_error, deltas, args.iterations, args.seed, pool, trials
+            )
+        if store is not None:
+            store.finish_run(trials.run_id, best_error)
+    finally:
+        # Interrupted runs keep every evaluation made so far; re-run to resume
+        if store is not None:
+            store.close()
             
     print("\n=== OPTIMIZATION COMPLETE ===")
     print(f"Best Error: {best_error*100:.2f}%")
+    print(f"Full validation-set evaluations: {full_evals}")
     print("Best Weights:")
     for k, v in best_weights.items():
         print(f"  {k}: {v}")
 
     # Save to file
-    with open('optimized_params.txt', 'w') as f:
-        f.write(str(best_weights))
+    write_params(args.output, best_weights, best_error, search=args.search, seed=args.seed,
+                 dataset=index.fingerprint, validation=validation_key(validation))
+    print(f"Wrote {args.output}")
+
+    if args.profile:
+        profiler.report()
+        profiler.write(args.profile)
 
 if __name__ == "__main__":
     main()
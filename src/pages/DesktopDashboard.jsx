@@ -1,8 +1,10 @@
 import { useState, useMemo } from 'react'
-import auctionData from '../data/auctions.json'
-import { calculateValuation, calculateValuationForExplore, calculateDealerInsights, calculateNeighborAverages, VARIANT_SHORT_NAMES, VARIANT_NAMES } from '../utils/valuationAlgorithm'
+import compactAuctions from '../data/auctions.compact.json'
+import { calculateValuation, calculateValuationForExplore, calculateDealerInsights, calculateNeighborAverages, decodeAuctions, VARIANT_SHORT_NAMES, VARIANT_NAMES } from '../utils/valuationAlgorithm'
 import '../App.css'
 
+const auctionData = decodeAuctions(compactAuctions)
+
 // Car Configuration Component
 function CarConfigurator({ config, setConfig }) {
   // Combined model+highland selection value
@@ -45,6 +45,55 @@ export const VARIANT_SHORT_NAMES = {
   my_p: 'Performance'
 };
 
+// Decode the compact export written by clean_data_final.py (auctions.compact.json):
+// cohort groups of column arrays -> auction records in export order. The records
+// of each cohort are also kept in `auctions.cohorts` so valuations can skip the
+// cohort scan.
+const DAY_MS = 24 * 60 * 60 * 1000;
+
+export function cohortKey(car) {
+  return `${car.model}|${car.variant_clean}|${car.is_highland}|${car.tax_type}`;
+}
+
+export function decodeAuctions(compact) {
+  const category = (column, code) => (code < 0 ? null : compact.categories[column][code]);
+  const auctions = [];
+  const cohorts = new Map();
+
+  for (const { key, columns } of compact.cohorts) {
+    const [model, variant_clean, is_highland, tax_type] = key;
+    const records = columns.row.map((row, i) => ({
+      auction_id: columns.auction_id[i],
+      model,
+      variant_clean,
+      is_highland,
+      tax_type,
+      is_accident_free: columns.is_accident_free[i] === 1,
+      tire_strategy: category('tire_strategy', columns.tire_strategy[i]),
+      has_hitch: columns.has_hitch[i] === 1,
+      autopilot: category('autopilot', columns.autopilot[i]),
+      has_heatpump: columns.has_heatpump[i] === 1,
+      mileage: columns.mileage[i],
+      age_at_auction_months: columns.age_at_auction_months[i],
+      first_registration: new Date(columns.first_registration[i] * DAY_MS).toISOString().slice(0, 10),
+      end_time: new Date(columns.end_time[i] * 1000).toISOString().slice(0, 19),
+      final_price: columns.final_price[i],
+      status: category('status', columns.status[i]),
+      number_of_bids: columns.number_of_bids[i],
+      trust_tier: category('trust_tier', columns.trust_tier[i]),
+      row
+    }));
+    cohorts.set(cohortKey({ model, variant_clean, is_highland, tax_type }), records);
+    auctions.push(...records);
+  }
+
+  auctions.sort((a, b) => a.row - b.row);
+  for (const records of cohorts.values()) records.sort((a, b) => a.row - b.row);
+  auctions.forEach(car => { delete car.row; });
+  Object.defineProperty(auctions, 'cohorts', { value: cohorts, enumerable: false });
+  return auctions;
+}
+
 // Calculate months between two dates
 function monthsBetween(date1, date2) {
   const d1 = new Date(date1);
@@ -222,7 +271,9 @@ export function calculateValuation(targetCar, auctionData, referenceDate = null)
   };
 
   // HARD FILTERS (Cohort)
-  const cohort = auctionData.filter(car => {
+  // Decoded compact data comes pre-grouped by cohort key; plain arrays are scanned
+  const candidates = auctionData.cohorts?.get(cohortKey(target)) ?? auctionData;
+  const cohort = candidates.filter(car => {
     return (
       car.model === target.model &&
       car.variant_clean === target.variant_clean &&
@@ -1,10 +1,24 @@
+import argparse
+import json
+import time
 import pandas as pd
 import numpy as np
 from datetime import datetime
 
+from dataset_cache import load_clean_data
+from evaluation_store import read_params
+from instrumentation import profiler
+from valuation_cache import ValuationCache
+from valuation_engine import (
+    BAND_LEVEL, PRICE_ADJUSTMENTS, CohortIndex, ModelParams, add_feature_codes, check_distance_kernel,
+    check_price_adjustments, predict, predict_batch, predict_with_band,
+)
+
 # Configuration
 INPUT_FILE = 'tesla_final_clean.csv'
 TOP_N = 20
+REGRESSION_FILE = 'valuation_regression.json'  # Pinned predictions for the TOP_N cars (--check)
+REGRESSION_RTOL = 1e-9
 
 # Weights & Parameters
 WEIGHTS = {
@@ -22,147 +36,216 @@ WEIGHTS = {
     'TRUST_TIER_3_PENALTY': 123,
 }
 
-PRICE_ADJUSTMENTS = {
-    'M3_MILEAGE_ADJ_PER_KM': 0.05,
-    'MY_MILEAGE_ADJ_PER_KM': 0.08,
-    'HITCH_ADJ': 250
-}
-
 IDW_POWER = 2.8
 K_NEIGHBORS = 3
+LOOKBACK_DAYS = None  # Hard lookback window for comparables in days (None = whole history)
+
+# Everything the engine needs (same dict layout as optimize_algo.py)
+MODEL_PARAMS = ModelParams({**WEIGHTS, 'K_NEIGHBORS': K_NEIGHBORS, 'IDW_POWER': IDW_POWER}, PRICE_ADJUSTMENTS)
+
+# Memoized predict_valuation() results (see valuation_cache.py)
+VALUATION_CACHE = ValuationCache()
+
+def use_params(params):
+    # Replace the pinned parameters above, e.g. with the best weights of an
+    # optimizer run (optimized_params.json). MODEL_PARAMS is updated in place,
+    # so modules that imported it see the new values too.
+    unknown = set(params) - set(MODEL_PARAMS)
+    if unknown:
+        raise ValueError(f"unknown parameter(s): {', '.join(sorted(unknown))}")
+    MODEL_PARAMS.update(params)
 
 def load_data():
-    df = pd.read_csv(INPUT_FILE)
-    df['end_time'] = pd.to_datetime(df['end_time'])
-    # Ensure final_price is numeric
-    df['final_price'] = pd.to_numeric(df['final_price'], errors='coerce')
+    # Parsed columns (end_time as datetime, numeric final_price) come from the
+    # columnar cache next to the CSV; it is rebuilt whenever the CSV changes.
+    df = load_clean_data(INPUT_FILE)
     # Use 30.44 days per month for accurate calculations if needed, but 'age_at_auction_months' is already there
-    return df
+    # Integer codes for the distance kernel
+    return add_feature_codes(df)
 
-def calculate_distance(target, candidate):
-    score = 0
-    
-    # 1. Mileage Difference
-    mileage_diff = abs(target['mileage'] - candidate['mileage'])
-    if target['model'] == 'Model 3':
-        score += mileage_diff * WEIGHTS['M3_MILEAGE_PENALTY_PER_KM']
-    else:
-        score += mileage_diff * WEIGHTS['MY_MILEAGE_PENALTY_PER_KM']
-        
-    # 2. Relative Age Difference
-    # Compare Target Age (Today/Now) vs Candidate Age (At Auction)
-    # BUT: In this simulation, "Today" is the target's auction date.
-    # So we compare Target's Age at its auction vs Candidate's Age at its auction.
-    # This aligns effectively with "comparing comparable cars".
-    # Wait, strict reading: "Target Car Age (Today) vs Comparable Car Age (At Auction Date)"
-    # If I am simulating a past prediction, "Today" is the Target's auction end time.
-    age_diff = abs(target['age_at_auction_months'] - candidate['age_at_auction_months'])
-    if target['model'] == 'Model 3':
-        score += age_diff * WEIGHTS['M3_AGE_PENALTY_PER_MONTH']
-    else:
-        score += age_diff * WEIGHTS['MY_AGE_PENALTY_PER_MONTH']
-        
-    # 3. Recency (Time Decay)
-    # Days between Target Auction and Candidate Auction
-    days_diff = (target['end_time'] - candidate['end_time']).days
-    # Ensure we don't have negative days (future queries) - handled by filtering, but good to be safe
-    days_diff = max(0, days_diff) 
-    score += days_diff * WEIGHTS['RECENCY_PENALTY_PER_DAY']
-    
-    # 4. Tire Mismatch
-    t_tire = target['tire_strategy']
-    c_tire = candidate['tire_strategy']
-    
-    if t_tire == '8_tires' and c_tire != '8_tires':
-        score += WEIGHTS['TIRE_MISMATCH_8_VS_4']
-    elif t_tire != '8_tires' and c_tire == '8_tires':
-        score += WEIGHTS['TIRE_MISMATCH_4_VS_8']
-    elif t_tire != c_tire:
-        score += WEIGHTS['TIRE_TYPE_MISMATCH']
-        
-    # 5. Heat Pump Mismatch
-    if target['has_heatpump'] != candidate['has_heatpump']:
-        score += WEIGHTS['HEAT_PUMP_MISMATCH']
-        
-    # 6. Autopilot Mismatch
-    if target['autopilot'] != candidate['autopilot']:
-        score += WEIGHTS['AUTOPILOT_MISMATCH']
-        
-    # 7. Trust Tier
-    tier = candidate['trust_tier']
-    if tier == 'Tier 2':
-        score += WEIGHTS['TRUST_TIER_2_PENALTY']
-    elif tier == 'Tier 3':
-        score += WEIGHTS['TRUST_TIER_3_PENALTY']
-        
-    return score
+def predict_valuation(target, index, cache=VALUATION_CACHE):
+    # Repeated lookups of the same configuration are served from the cache
+    # (pass cache=None to always recompute)
+    if cache is None:
+        return compute_valuation(target, index)
+    key = cache.key(target, index, MODEL_PARAMS, PRICE_ADJUSTMENTS)
+    cached = cache.get(key)
+    if cached is None:
+        cached = compute_valuation(target, index)
+        cache.put(key, cached)
+    predicted_price, n, neighbors = cached
+    return predicted_price, n, [dict(neighbor) for neighbor in neighbors]
 
-def adjust_price(target, candidate):
-    price = candidate['final_price']
-    
-    # 1. Mileage Adjustment
-    # Target Price = Candidate Price + (Candidate Miles - Target Miles) * Rate
-    mileage_delta = candidate['mileage'] - target['mileage']
-    rate = PRICE_ADJUSTMENTS['M3_MILEAGE_ADJ_PER_KM'] if target['model'] == 'Model 3' else PRICE_ADJUSTMENTS['MY_MILEAGE_ADJ_PER_KM']
-    price += mileage_delta * rate
-    
-    # 2. Trailer Hitch Adjustment
-    # If Target has hitch and Candidate doesn't: Add value to candidate base
-    if target['has_hitch'] and not candidate['has_hitch']:
-        price += PRICE_ADJUSTMENTS['HITCH_ADJ']
-    # If Target doesn't have hitch and Candidate does: Subtract value from candidate base
-    elif not target['has_hitch'] and candidate['has_hitch']:
-        price -= PRICE_ADJUSTMENTS['HITCH_ADJ']
-        
-    return price
-
-def predict_valuation(target, data):
-    # HARD FILTERS (Cohort)
-    cohort = data[
-        (data['model'] == target['model']) &
-        (data['variant_clean'] == target['variant_clean']) &
-        (data['is_highland'] == target['is_highland']) &
-        (data['tax_type'] == target['tax_type']) &
-        (data['is_accident_free'] == True) & # Comparables must be accident free
-        (data['final_price'].notna()) & # Must have a price
-        (data['end_time'] < target['end_time']) # NO DATA LEAKAGE: Only past auctions
-    ].copy()
-
-    # Exclude the target itself (redundant with end_time < target_end_time check if timestamps exact, but safe)
-    cohort = cohort[cohort['auction_id'] != target['auction_id']]
-    
-    if len(cohort) == 0:
-        return None, 0, []
+def compute_valuation(target, index):
+    return predict(target, index, MODEL_PARAMS)
 
-    # Calculate Distances
-    cohort['distance'] = cohort.apply(lambda row: calculate_distance(target, row), axis=1)
-    
-    # Sort by Distance
-    cohort = cohort.sort_values('distance')
-    
-    # Select Top K
-    neighbors = cohort.head(K_NEIGHBORS)
-    
-    if len(neighbors) == 0:
-        return None, 0, []
-
-    # Calculate Weighted Average
-    # IDW: weight = 1 / (distance^p + epsilon)
-    # Using a small epsilon to avoid div by zero if distance is 0
-    epsilon = 1e-6
-    neighbors['weight'] = 1 / ((neighbors['distance'] + epsilon) ** IDW_POWER)
-    
-    # Adjust Prices
-    neighbors['adjusted_price'] = neighbors.apply(lambda row: adjust_price(target, row), axis=1)
-    
-    # Weighted Sum
-    total_weight = neighbors['weight'].sum()
-    predicted_price = (neighbors['adjusted_price'] * neighbors['weight']).sum() / total_weight
-    
-    return predicted_price, len(neighbors), neighbors[['auction_id', 'distance', 'adjusted_price']].to_dict('records')
+def predict_band(target, index):
+    # predict_valuation() plus the bootstrap band of the estimate (see bootstrap_band())
+    return predict_with_band(target, index, MODEL_PARAMS)
+
+def check_kernel(df):
+    # The vectorized kernel must reproduce calculate_distance() and adjust_price() exactly
+    mismatches, total = check_distance_kernel(df, MODEL_PARAMS)
+    print(f"Distance kernel check: {total - mismatches}/{total} scores identical")
+
+    price_mismatches = check_price_adjustments(df, PRICE_ADJUSTMENTS)
+    print(f"Price adjustment check: {price_mismatches} mismatches")
+    return mismatches == 0 and price_mismatches == 0
+
+def closed_auctions(df):
+    # Sold or declined auctions with a highest bid to compare against
+    return df[
+        df['status'].str.contains('sold|accepted|declined', case=False, na=False) &
+        df['final_price'].notna()
+    ]
+
+def recent_closed(df, n=TOP_N):
+    # The n most recent closed auctions (the cars of valuation_results_summary.csv)
+    return closed_auctions(df).sort_values('end_time', ascending=False).head(n)
+
+def pin_predictions(df, path=REGRESSION_FILE):
+    # Record the current predictions for the TOP_N cars as the regression baseline
+    targets = recent_closed(df)
+    index = CohortIndex(df, LOOKBACK_DAYS)
+    predictions = predict_batch(targets, index, MODEL_PARAMS)
+    pinned = {
+        'dataset': index.fingerprint,
+        'params': dict(MODEL_PARAMS),
+        'price_adjustments': PRICE_ADJUSTMENTS,
+        'predictions': [
+            {'auction_id': str(auction_id), 'end_time': end_time.isoformat(), 'predicted_price': float(price)}
+            for auction_id, end_time, price in zip(targets['auction_id'], targets['end_time'], predictions['predicted_price'])
+        ],
+    }
+    with open(path, 'w') as f:
+        json.dump(pinned, f, indent=2)
+        f.write('\n')
+    print(f"Pinned {len(targets)} predictions to {path}")
+
+def check_regression(df, path=REGRESSION_FILE):
+    # Current predictions for the pinned cars against the baseline, through the
+    # single-target, bootstrap band and batch paths
+    with open(path) as f:
+        pinned = json.load(f)
+    index = CohortIndex(df, LOOKBACK_DAYS)
+    if pinned['dataset'] != index.fingerprint:
+        print("Warning: the data set changed since the predictions were pinned")
+    if pinned['params'] != dict(MODEL_PARAMS) or pinned['price_adjustments'] != PRICE_ADJUSTMENTS:
+        print("Warning: the parameters changed since the predictions were pinned")
+
+    expected = pd.DataFrame(pinned['predictions'])
+    targets = df.set_index(df['auction_id'].astype(str)).loc[expected['auction_id']]
+    paths = {
+        'predict_valuation': [predict_valuation(target, index, cache=None)[0] for _, target in targets.iterrows()],
+        'predict_band': [predict_band(target, index)[0] for _, target in targets.iterrows()],
+        'predict_batch': predict_batch(targets, index, MODEL_PARAMS)['predicted_price'].tolist(),
+    }
+    ok = True
+    for name, values in paths.items():
+        values = np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+        matches = np.isclose(values, expected['predicted_price'].to_numpy(), rtol=REGRESSION_RTOL, atol=0)
+        print(f"{name:<18} {matches.sum()}/{len(matches)} predictions match {path}")
+        for auction_id, got, want in zip(expected['auction_id'][~matches], values[~matches], expected['predicted_price'][~matches]):
+            print(f"  {auction_id}: {got:.2f} (pinned {want:.2f})")
+        ok &= bool(matches.all())
+    return ok
+
+def error_breakdown(res_df, by):
+    # Error statistics per group of the walk-forward results
+    grouped = res_df.groupby(by, observed=True)
+    return pd.DataFrame({
+        'n': grouped.size(),
+        'mean_abs_err_pct': grouped['error_pct'].mean(),
+        'median_abs_err_pct': grouped['error_pct'].median(),
+        'bias_pct': grouped['raw_error_pct'].mean(),
+    }).round(2)
+
+def walk_forward(df, output=None):
+    # Leakage-free backtest over the whole history: every closed auction is
+    # valued from the auctions that ended before it, walking each cohort in
+    # end_time order (see predict_batch).
+    started = time.perf_counter()
+    targets = closed_auctions(df).sort_values('end_time', kind='stable')
+    index = CohortIndex(df, LOOKBACK_DAYS)
+    predictions = predict_batch(targets, index, MODEL_PARAMS)
+    elapsed = time.perf_counter() - started
+
+    valued = predictions['neighbors'] > 0
+    res_df = pd.DataFrame({
+        'auction_id': targets['auction_id'],
+        'end_time': targets['end_time'],
+        'month': targets['end_time'].dt.strftime('%Y-%m'),
+        'variant': targets['variant_clean'],
+        'trust_tier': targets['trust_tier'],
+        'actual_bid': targets['final_price'],
+        'predicted_bid': predictions['predicted_price'],
+        'neighbors': predictions['neighbors'],
+    })[valued]
+    res_df['raw_error_pct'] = (res_df['predicted_bid'] - res_df['actual_bid']) / res_df['actual_bid'] * 100
+    res_df['error_pct'] = res_df['raw_error_pct'].abs()
+
+    print(f"\n=== WALK-FORWARD BACKTEST ({elapsed:.2f}s) ===")
+    print(f"Closed auctions: {len(targets)}, valued: {len(res_df)}, without comparables: {int((~valued).sum())}")
+    if len(res_df) == 0:
+        return res_df
+    print(f"Average Absolute Error: {res_df['error_pct'].mean():.2f}%")
+    print(f"Median Absolute Error: {res_df['error_pct'].median():.2f}%")
+    print(f"Average Bias (Pred vs Actual): {res_df['raw_error_pct'].mean():.2f}% (Positive means over-prediction)")
+
+    pd.set_option('display.width', 1000)
+    for title, by in [('Variant', 'variant'), ('Month', 'month'), ('Trust Tier', 'trust_tier')]:
+        print(f"\n--- By {title} ---")
+        print(error_breakdown(res_df, by).to_string())
+
+    if output:
+        res_df.to_csv(output, index=False)
+        print(f"\nSaved {len(res_df)} backtest results to {output}")
+    return res_df
 
 def main():
+    parser = argparse.ArgumentParser(description="Backtest the valuation on the most recent closed auctions.")
+    parser.add_argument('--check-kernel', action='store_true', help="Verify the vectorized distance kernel against calculate_distance() and exit")
+    parser.add_argument('--check', action='store_true', help=f"Compare the predictions for the TOP_N cars with the pinned ones ({REGRESSION_FILE}) and exit")
+    parser.add_argument('--pin', action='store_true', help=f"Re-pin the current predictions for the TOP_N cars to {REGRESSION_FILE} and exit")
+    parser.add_argument('--walk-forward', action='store_true', help="Backtest every closed auction in history instead of the latest TOP_N")
+    parser.add_argument('--output', help="With --walk-forward: write the per-auction results to this CSV")
+    parser.add_argument('--params', metavar='JSON', help="Use the weights in this file (optimize_algo.py writes optimized_params.json) instead of the pinned ones")
+    parser.add_argument('--lookback-days', type=int, help="Only use comparables that ended at most this many days before the target")
+    parser.add_argument('--band', action='store_true', help="Also compute the bootstrap band of every estimate (see bootstrap_band())")
+    parser.add_argument('--profile', metavar='PATH', help="Record stage timings and counters; write them to PATH (.json summary, otherwise pstats)")
+    args = parser.parse_args()
+
+    global LOOKBACK_DAYS
+    if args.lookback_days is not None:
+        LOOKBACK_DAYS = args.lookback_days
+    if args.params:
+        use_params(read_params(args.params))
+        print(f"Using parameters from {args.params}")
+    if args.profile:
+        profiler.enable()
+    try:
+        run(args)
+    finally:
+        if args.profile:
+            profiler.report()
+            profiler.write(args.profile)
+
+def run(args):
     df = load_data()
+
+    if args.check_kernel:
+        raise SystemExit(0 if check_kernel(df) else 1)
+
+    if args.check:
+        raise SystemExit(0 if check_regression(df) else 1)
+
+    if args.pin:
+        pin_predictions(df)
+        return
+
+    if args.walk_forward:
+        walk_forward(df, args.output)
+        return
     
     # Filter for Target Cars: "most recent 20 auctions that have been either sold or declined"
     # Statuses: 'sold', 'closed_seller_accepted' -> Sold
@@ -172,25 +255,24 @@ def main():
     # Start by checking what statuses actually exist
     # (Doing this blind, but I recall previous output showing 'active', 'preparation'. I assume the above form keys)
     # Let's filter loosely first
-    targets = df[
-        df['status'].str.contains('sold|accepted|declined', case=False, na=False) &
-        df['final_price'].notna() # Must have a highest bid to compare against
-    ].copy()
-    
-    # Sort by End Time Descending
-    targets = targets.sort_values('end_time', ascending=False).head(TOP_N)
+    # Most recent first
+    targets = recent_closed(df)
     
+    index = CohortIndex(df, LOOKBACK_DAYS)
     results = []
     
     print(f"Analyzing top {len(targets)} most recent closed auctions...")
     
-    for _, target in targets.iterrows():
-        # Perform Valuation
-        pred_price, num_neighbors, _ = predict_valuation(target, df)
+    # Perform Valuation (all targets in one batch)
+    predictions = predict_batch(targets, index, MODEL_PARAMS)
+    
+    for (_, target), (_, prediction) in zip(targets.iterrows(), predictions.iterrows()):
+        pred_price = prediction['predicted_price']
+        num_neighbors = prediction['neighbors']
         
         actual_price = target['final_price']
         
-        if pred_price is not None:
+        if num_neighbors > 0:
             error = pred_price - actual_price
             error_pct = (error / actual_price) * 100  # (Pred - Actual) / Actual ?? Usually |Pred-Actual|/Actual for Mean Absolute % Error
             # User asked for "avg and median error rate".
@@ -198,7 +280,14 @@ def main():
             # I'll calculate Absolute Error % for the "Error Rate" metric.
             abs_error_pct = abs(error_pct)
             
+            if args.band:
+                band = predict_band(target, index)[3]
+                band_bounds = {'band_low': band['low'], 'band_high': band['high']}
+            else:
+                band_bounds = {}
+
             results.append({
+                **band_bounds,
                 'auction_id': target['auction_id'],
                 'model': target['model'],
                 'variant': target['variant_clean'],
@@ -227,6 +316,10 @@ def main():
         print(f"Average Absolute Error: {avg_error:.2f}%")
         print(f"Median Absolute Error: {median_error:.2f}%")
         print(f"Average Bias (Pred vs Actual): {avg_bias:.2f}% (Positive means over-prediction)")
+        if args.band:
+            # The band is the spread of resampled estimates, not a prediction interval
+            covered = (res_df['band_low'] <= res_df['actual_bid']) & (res_df['actual_bid'] <= res_df['band_high'])
+            print(f"Actual bid inside the bootstrap band (central {BAND_LEVEL:.0%} of resampled estimates): {covered.mean() * 100:.0f}%")
         
         print("\n--- Detailed List ---")
         # Format for display
@@ -240,6 +333,8 @@ def main():
         res_display['actual_bid'] = res_display['actual_bid'].apply(lambda x: f"€{x:,.0f}")
         res_display['predicted_bid'] = res_display['predicted_bid'].apply(lambda x: f"€{x:,.0f}")
         res_display['error_pct'] = res_display['error_pct'].apply(lambda x: f"{x:.2f}%")
+        if args.band:
+            res_display['bootstrap_band'] = [f"€{low:,.0f} - €{high:,.0f}" for low, high in zip(res_df['band_low'], res_df['band_high'])]
         
         print(res_display.to_string(index=False))
         
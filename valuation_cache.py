@@ -0,0 +1,84 @@
+import threading
+from collections import OrderedDict
+
+from instrumentation import profiler
+from valuation_engine import cohort_key, encode_target
+
+# Memoized valuations. A valuation only depends on the target's comparable
+# features, the comparables in the index and the parameters, so results are
+# stored under (index fingerprint, target feature tuple, parameters). Looking
+# up a target with another fingerprint (new auctions ingested, data reloaded)
+# drops every entry first, and results computed on an index that has been
+# replaced meanwhile are not stored. Size is bounded; the least recently used
+# entry is evicted. The key includes the target's exact end time, so callers
+# valuing cars "as of now" must round it (valuation_server.py floors it to
+# LIVE_TIME_STEP) or every lookup is a miss. Safe to share between threads.
+
+CACHE_SIZE = 10_000
+
+
+class ValuationCache:
+    def __init__(self, max_size=CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.fingerprint = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def key(self, target, index, *params):
+        # Everything the valuation of `target` reads: the index, cohort, encoded
+        # features, the target's own id when it is one of the comparables (it
+        # is excluded then) and every parameter dict
+        with self.lock:
+            if index.fingerprint != self.fingerprint:
+                if self.entries:
+                    self.invalidations += 1
+                self.entries.clear()
+                self.fingerprint = index.fingerprint
+
+        auction_id = target.get('auction_id')
+        own_id = auction_id if auction_id is not None and auction_id in index else None
+        features = tuple(encode_target(target).values())
+        return (index.fingerprint, cohort_key(target), features, own_id) + tuple(tuple(sorted(p.items())) for p in params)
+
+    def get(self, key):
+        # Cached value or None
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                profiler.count('valuation_cache_miss')
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        profiler.count('valuation_cache_hit')
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key[0] != self.fingerprint:
+                return
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
@@ -0,0 +1,1051 @@
+import functools
+import hashlib
+import math
+
+import pandas as pd
+import numpy as np
+
+from instrumentation import profiler
+
+# Valuation engine shared by validate_algo.py, optimize_algo.py and the
+# valuation server. The readable row-by-row calculate_distance() and
+# adjust_price() below are the reference implementation; everything else scores
+# whole cohorts with array operations and must produce exactly the same numbers.
+# ModelParams bundles the weights, K, IDW power and price adjustments of a
+# model; predict() / predict_batch() value one target / many targets with them.
+
+DAY_NS = 86_400_000_000_000
+
+# Closed output domains of the translation layer (clean_data_final.py).
+# Categoricals are stored as integer codes into these lists; anything outside
+# the list is encoded as -1.
+TIRE_STRATEGIES = ['8_tires', '4_summer', '4_winter', '4_all_season', 'unknown']
+AUTOPILOT_LEVELS = ['Standard', 'EAP', 'FSD']
+TRUST_TIERS = ['Tier 1', 'Tier 2', 'Tier 3']
+
+CATEGORY_LEVELS = {
+    'tire_strategy': TIRE_STRATEGIES,
+    'autopilot': AUTOPILOT_LEVELS,
+    'trust_tier': TRUST_TIERS,
+}
+
+EIGHT_TIRES_CODE = TIRE_STRATEGIES.index('8_tires')
+
+# Price Adjustments of a comparable towards the target (fixed, not optimized)
+PRICE_ADJUSTMENTS = {
+    'M3_MILEAGE_ADJ_PER_KM': 0.05,
+    'MY_MILEAGE_ADJ_PER_KM': 0.08,
+    'HITCH_ADJ': 250
+}
+
+# Target cars valued by the server and the batch CLI: fields a target must
+# have, and defaults for the optional ones
+REQUIRED_FIELDS = ['model', 'variant_clean', 'tax_type', 'mileage']
+TARGET_DEFAULTS = {
+    'is_highland': False,
+    'tire_strategy': 'unknown',
+    'has_heatpump': False,
+    'autopilot': 'Standard',
+    'has_hitch': False,
+    'trust_tier': 'Tier 1',
+}
+FLAG_COLUMNS = ['is_highland', 'has_heatpump', 'has_hitch']
+TRUE_VALUES = ['true', 't', '1', 'yes']  # Flag spellings read as True (case-insensitive)
+MONTH = pd.Timedelta(days=30.44)
+
+
+def encode_category(values, column):
+    return pd.Categorical(values, categories=CATEGORY_LEVELS[column]).codes.astype(np.int8)
+
+
+def encode_value(value, column):
+    levels = CATEGORY_LEVELS[column]
+    return levels.index(value) if value in levels else -1
+
+
+def to_ns(end_time):
+    # Works for Series and scalars regardless of the datetime resolution pandas picked
+    if isinstance(end_time, pd.Series):
+        return end_time.astype('datetime64[ns]').to_numpy().view(np.int64)
+    return pd.Timestamp(end_time).as_unit('ns').value
+
+
+def age_in_months(end_time, first_registration):
+    # Whole months between registration and end_time, as age_at_auction_months
+    # is defined in clean_data_final.py (scalars or Series; NaT gives NaN)
+    return np.trunc((end_time - first_registration) / MONTH)
+
+
+def add_feature_codes(df):
+    # Pre-encode the columns the distance kernel needs, once at load time
+    for column in CATEGORY_LEVELS:
+        df[column + '_code'] = encode_category(df[column], column)
+    df['end_ns'] = to_ns(df['end_time'])
+    return df
+
+
+def encode_features(df):
+    # Column arrays for a frame of candidates. Uses the pre-encoded columns
+    # from add_feature_codes() when present.
+    if 'end_ns' not in df.columns:
+        df = add_feature_codes(df.copy())
+    return {
+        'mileage': df['mileage'].to_numpy(dtype=np.float64),
+        'age': df['age_at_auction_months'].to_numpy(dtype=np.float64),
+        'end_ns': df['end_ns'].to_numpy(dtype=np.int64),
+        'tire': df['tire_strategy_code'].to_numpy(),
+        'heatpump': df['has_heatpump'].to_numpy(dtype=bool),
+        'autopilot': df['autopilot_code'].to_numpy(),
+        'trust_tier': df['trust_tier_code'].to_numpy(),
+        'has_hitch': df['has_hitch'].to_numpy(dtype=bool),
+        'price': df['final_price'].to_numpy(dtype=np.float64) if 'final_price' in df.columns else None,
+    }
+
+
+def encode_target(target):
+    # Scalar counterpart of encode_features() for a single target car
+    def code(column):
+        if column + '_code' in target:
+            return int(target[column + '_code'])
+        return encode_value(target[column], column)
+
+    return {
+        'is_model_3': target['model'] == 'Model 3',
+        'mileage': target['mileage'],
+        'age': target['age_at_auction_months'],
+        'end_ns': int(target['end_ns']) if 'end_ns' in target else to_ns(target['end_time']),
+        'tire': code('tire_strategy'),
+        'heatpump': bool(target['has_heatpump']),
+        'autopilot': code('autopilot'),
+        'has_hitch': bool(target['has_hitch']),
+    }
+
+
+def tier_penalties(weights):
+    # Lookup table indexed by trust tier code. The trailing 0 catches code -1.
+    penalties = np.zeros(len(TRUST_TIERS) + 1)
+    penalties[TRUST_TIERS.index('Tier 2')] = weights['TRUST_TIER_2_PENALTY']
+    penalties[TRUST_TIERS.index('Tier 3')] = weights['TRUST_TIER_3_PENALTY']
+    return penalties
+
+
+def calculate_distance(target, candidate, weights):
+    # Reference distance between two rows (Series or dicts) of the cleaned data
+    score = 0
+    
+    # 1. Mileage Difference
+    mileage_diff = abs(target['mileage'] - candidate['mileage'])
+    if target['model'] == 'Model 3':
+        score += mileage_diff * weights['M3_MILEAGE_PENALTY_PER_KM']
+    else:
+        score += mileage_diff * weights['MY_MILEAGE_PENALTY_PER_KM']
+        
+    # 2. Relative Age Difference
+    # Target's age at its auction vs candidate's age at its auction (for a live
+    # valuation the target's auction date is today)
+    age_diff = abs(target['age_at_auction_months'] - candidate['age_at_auction_months'])
+    if target['model'] == 'Model 3':
+        score += age_diff * weights['M3_AGE_PENALTY_PER_MONTH']
+    else:
+        score += age_diff * weights['MY_AGE_PENALTY_PER_MONTH']
+        
+    # 3. Recency (Time Decay)
+    # Days between Target Auction and Candidate Auction, never negative
+    days_diff = (target['end_time'] - candidate['end_time']).days
+    days_diff = max(0, days_diff) 
+    score += days_diff * weights['RECENCY_PENALTY_PER_DAY']
+    
+    # 4. Tire Mismatch
+    t_tire = target['tire_strategy']
+    c_tire = candidate['tire_strategy']
+    
+    if t_tire == '8_tires' and c_tire != '8_tires':
+        score += weights['TIRE_MISMATCH_8_VS_4']
+    elif t_tire != '8_tires' and c_tire == '8_tires':
+        score += weights['TIRE_MISMATCH_4_VS_8']
+    elif t_tire != c_tire:
+        score += weights['TIRE_TYPE_MISMATCH']
+        
+    # 5. Heat Pump Mismatch
+    if target['has_heatpump'] != candidate['has_heatpump']:
+        score += weights['HEAT_PUMP_MISMATCH']
+        
+    # 6. Autopilot Mismatch
+    if target['autopilot'] != candidate['autopilot']:
+        score += weights['AUTOPILOT_MISMATCH']
+        
+    # 7. Trust Tier
+    tier = candidate['trust_tier']
+    if tier == 'Tier 2':
+        score += weights['TRUST_TIER_2_PENALTY']
+    elif tier == 'Tier 3':
+        score += weights['TRUST_TIER_3_PENALTY']
+        
+    return score
+
+
+def adjust_price(target, candidate, price_adjustments):
+    # Reference price of a comparable, adjusted to the target
+    price = candidate['final_price']
+    
+    # 1. Mileage Adjustment
+    # Target Price = Candidate Price + (Candidate Miles - Target Miles) * Rate
+    mileage_delta = candidate['mileage'] - target['mileage']
+    rate = price_adjustments['M3_MILEAGE_ADJ_PER_KM'] if target['model'] == 'Model 3' else price_adjustments['MY_MILEAGE_ADJ_PER_KM']
+    price += mileage_delta * rate
+    
+    # 2. Trailer Hitch Adjustment
+    # If Target has hitch and Candidate doesn't: Add value to candidate base
+    if target['has_hitch'] and not candidate['has_hitch']:
+        price += price_adjustments['HITCH_ADJ']
+    # If Target doesn't have hitch and Candidate does: Subtract value from candidate base
+    elif not target['has_hitch'] and candidate['has_hitch']:
+        price -= price_adjustments['HITCH_ADJ']
+        
+    return price
+
+
+def distance_kernel(t, features, weights):
+    # Same terms, same order of additions as calculate_distance(), so every
+    # score is bit-for-bit identical to the row-by-row version.
+    # Target values may be scalars or (m, 1) columns of several targets from the
+    # same model; the result then is an (m, n) distance matrix.
+    if t['is_model_3']:
+        mileage_w = weights['M3_MILEAGE_PENALTY_PER_KM']
+        age_w = weights['M3_AGE_PENALTY_PER_MONTH']
+    else:
+        mileage_w = weights['MY_MILEAGE_PENALTY_PER_KM']
+        age_w = weights['MY_AGE_PENALTY_PER_MONTH']
+
+    # 1. Mileage
+    score = np.abs(t['mileage'] - features['mileage']) * mileage_w
+
+    # 2. Relative Age
+    score += np.abs(t['age'] - features['age']) * age_w
+
+    # 3. Recency (floor division matches Timedelta.days)
+    days_diff = np.maximum((t['end_ns'] - features['end_ns']) // DAY_NS, 0)
+    score += days_diff * weights['RECENCY_PENALTY_PER_DAY']
+
+    # 4. Tire Mismatch (asymmetric)
+    c_is_8 = features['tire'] == EIGHT_TIRES_CODE
+    score += np.where(
+        t['tire'] == EIGHT_TIRES_CODE,
+        np.where(c_is_8, 0.0, weights['TIRE_MISMATCH_8_VS_4']),
+        np.where(c_is_8, weights['TIRE_MISMATCH_4_VS_8'],
+                 np.where(features['tire'] != t['tire'], weights['TIRE_TYPE_MISMATCH'], 0.0)),
+    )
+
+    # 5. Heat Pump Mismatch
+    score += np.where(features['heatpump'] != t['heatpump'], weights['HEAT_PUMP_MISMATCH'], 0.0)
+
+    # 6. Autopilot Mismatch
+    score += np.where(features['autopilot'] != t['autopilot'], weights['AUTOPILOT_MISMATCH'], 0.0)
+
+    # 7. Trust Tier
+    score += tier_penalties(weights)[features['trust_tier']]
+
+    return score
+
+
+def top_k(distances, rows, k):
+    # Positions of the k smallest distances ordered by (distance, row). Partial
+    # selection finds the k-th smallest value first; only candidates at or below
+    # it are sorted, and rows make ties deterministic.
+    if len(distances) > k:
+        kth = np.partition(distances, k - 1)[k - 1]
+        candidates = np.flatnonzero(distances <= kth)
+    else:
+        candidates = np.arange(len(distances))
+    order = np.lexsort((rows[candidates], distances[candidates]))[:k]
+    return candidates[order]
+
+
+def adjust_prices(t, features, positions, price_adjustments):
+    # Vectorized adjust_price() for the selected candidates. Like the kernel it
+    # broadcasts over (m, 1) target columns and (m, k) positions.
+    price = features['price'][positions]
+
+    # 1. Mileage Adjustment
+    rate = price_adjustments['M3_MILEAGE_ADJ_PER_KM'] if t['is_model_3'] else price_adjustments['MY_MILEAGE_ADJ_PER_KM']
+    price = price + (features['mileage'][positions] - t['mileage']) * rate
+
+    # 2. Trailer Hitch Adjustment
+    t_hitch = np.asarray(t['has_hitch'], dtype=bool)
+    c_hitch = features['has_hitch'][positions]
+    price += np.where(t_hitch & ~c_hitch, price_adjustments['HITCH_ADJ'], 0.0)
+    price -= np.where(~t_hitch & c_hitch, price_adjustments['HITCH_ADJ'], 0.0)
+    return price
+
+
+def nearest_neighbors(t, cohort, weights, k, price_adjustments):
+    # K nearest comparables: positions into the cohort arrays, their distances
+    # and their adjusted prices. Nothing else is materialized. Cohorts sorted by
+    # end time (CohortIndex) are scanned newest first with recency pruning.
+    if len(cohort['row']) > RECENCY_BLOCK and nonnegative_weights(weights):
+        with profiler.stage('recency_scan'):
+            positions, nearest = recent_neighbors(t, cohort, weights, k)
+    else:
+        with profiler.stage('distance'):
+            distances = distance_kernel(t, cohort, weights)
+        profiler.count('candidates_scored', len(distances))
+        with profiler.stage('top_k'):
+            positions = top_k(distances, cohort['row'], k)
+        nearest = distances[positions]
+    with profiler.stage('price_adjustment'):
+        adjusted = adjust_prices(t, cohort, positions, price_adjustments)
+    return positions, nearest, adjusted
+
+
+# Recency pruning. Every term of the distance is non-negative, so a score is at
+# least its recency term, and in a cohort sorted by end time every auction
+# older than a given one has at least its recency term (floating-point rounding
+# is monotone, so this holds for the computed scores too). Scanning newest
+# first, the scan can stop as soon as the recency term of the newest unscanned
+# auction is strictly greater than the current K-th distance: nothing older can
+# enter the top K, not even on a tie. The result is exactly the full scan's.
+RECENCY_BLOCK = 1024  # Auctions in the first block of a newest-first scan; blocks double from there
+
+
+def nonnegative_weights(weights):
+    return min(weights[name] for name in DELTA_WEIGHT_KEYS) >= 0
+
+
+def recency_bound(t_end_ns, end_ns, weights):
+    # Recency term of auctions that ended at end_ns (same expression as the kernel)
+    return np.maximum((t_end_ns - end_ns) // DAY_NS, 0) * weights['RECENCY_PENALTY_PER_DAY']
+
+
+def recent_neighbors(t, cohort, weights, k):
+    # top_k() of a cohort sorted by end_ns, scanned newest first in doubling
+    # blocks until the recency bound rules out everything older
+    rows, end_ns = cohort['row'], cohort['end_ns']
+    positions, distances = np.zeros(0, dtype=np.int64), np.zeros(0)
+    hi, block = len(rows), RECENCY_BLOCK
+    while hi > 0:
+        lo = max(hi - block, 0)
+        scores = distance_kernel(t, {name: values[lo:hi] for name, values in cohort.items()}, weights)
+        positions = np.concatenate([positions, np.arange(lo, hi)])
+        distances = np.concatenate([distances, scores])
+        picked = top_k(distances, rows[positions], k)
+        positions, distances = positions[picked], distances[picked]
+        profiler.count('candidates_scored', hi - lo)
+        hi, block = lo, block * 2
+        if hi > 0 and len(positions) == k and recency_bound(t['end_ns'], end_ns[hi - 1], weights) > distances[-1]:
+            profiler.count('candidates_pruned', hi)
+            break
+    return positions, distances
+
+
+def recent_columns(t, end_ns, lo, hi, weights, k, score):
+    # Matrix form of recent_neighbors() for a block of targets: score(a, b, rows)
+    # gives the masked distances of those target rows to cohort positions
+    # a..b-1. Scans [lo, hi) newest first; a target drops out as soon as the
+    # recency bound rules out everything older for it, and its remaining
+    # columns stay +inf -> (first scanned position, distances of [start, hi))
+    m = len(t['end_ns'])
+    active = np.arange(m)
+    chunks = []
+    best = np.zeros((m, 0))
+    start, block = hi, RECENCY_BLOCK
+    while start > lo and len(active):
+        chunk_start = max(start - block, lo)
+        chunk = np.full((m, start - chunk_start), np.inf)
+        chunk[active] = score(chunk_start, start, active)
+        chunks.append(chunk)
+        start, block = chunk_start, block * 2
+        best = np.hstack([best, chunk])
+        if best.shape[1] < k:
+            continue
+        best = np.partition(best, k - 1, axis=1)[:, :k]
+        if start > lo:
+            done = recency_bound(t['end_ns'][active, 0], end_ns[start - 1], weights) > best[active].max(axis=1)
+            profiler.count('candidates_pruned', int(done.sum()) * (start - lo))
+            active = active[~done]
+    return start, np.hstack(chunks[::-1])
+
+
+def check_distance_kernel(df, weights, reference=calculate_distance, n_targets=25):
+    # Equivalence check: score every row of the data against a spread of targets
+    # with both the kernel and the row-by-row reference and require exact equality.
+    df = add_feature_codes(df.copy())
+    features = encode_features(df)
+    positions = np.linspace(0, len(df) - 1, min(n_targets, len(df))).astype(int)
+    mismatches = 0
+    for pos in positions:
+        target = df.iloc[pos]
+        fast = distance_kernel(encode_target(target), features, weights)
+        slow = df.apply(lambda row: reference(target, row, weights), axis=1).to_numpy(dtype=np.float64)
+        mismatches += int(np.count_nonzero(fast != slow))
+    return mismatches, len(positions) * len(df)
+
+
+def check_price_adjustments(df, price_adjustments, reference=adjust_price, stride=40):
+    # Same for adjust_prices(): every priced row against every stride-th target
+    priced = df[df['final_price'].notna()]
+    features = encode_features(priced)
+    all_rows = np.arange(len(priced))
+    mismatches = 0
+    for _, target in priced.iloc[::stride].iterrows():
+        fast = adjust_prices(encode_target(target), features, all_rows, price_adjustments)
+        slow = priced.apply(lambda row: reference(target, row, price_adjustments), axis=1).to_numpy(dtype=np.float64)
+        mismatches += int(np.count_nonzero(fast != slow))
+    return mismatches
+
+
+# Leaf-bucket KD-tree for large cohorts. Candidates are split per categorical
+# combination (tire, heat pump, autopilot, trust tier) and then recursively at
+# the median of the widest continuous axis (mileage, age, end time) into leaves
+# of at most TREE_LEAF_SIZE rows. Scoring a leaf's bounding box with the point
+# closest to the target gives a lower bound of every score inside it (all
+# weights are non-negative and the kernel only adds non-negative terms), so
+# leaves are scanned in order of their bound until the bound exceeds the k-th
+# best score found. The result is exactly the linear scan's top-K.
+TREE_MIN_COHORT = 20_000   # Cohorts at least this large get a tree
+TREE_LEAF_SIZE = 256
+TREE_LEAVES_PER_STEP = 8   # Leaves scored per vectorized step of a query
+TREE_AXES = ['mileage', 'age', 'end_ns']
+TREE_AXIS_SCALE = np.array([0.0025, 15.0, 0.3 / DAY_NS])  # Typical weights; only guide the splits
+TREE_CATEGORIES = ['tire', 'heatpump', 'autopilot', 'trust_tier']
+
+
+def build_leaf_tree(cohort):
+    coords = np.column_stack([cohort[axis].astype(np.float64) for axis in TREE_AXES]) * TREE_AXIS_SCALE
+    leaves = []
+
+    def split(positions):
+        if len(positions) <= TREE_LEAF_SIZE:
+            leaves.append(positions)
+            return
+        spread = coords[positions].max(axis=0) - coords[positions].min(axis=0)
+        axis = int(np.argmax(spread))
+        if spread[axis] == 0:
+            leaves.append(positions)
+            return
+        half = len(positions) // 2
+        parted = positions[np.argpartition(coords[positions, axis], half)]
+        split(parted[:half])
+        split(parted[half:])
+
+    combos = np.column_stack([cohort[name].astype(np.int64) for name in TREE_CATEGORIES])
+    _, combo_of = np.unique(combos, axis=0, return_inverse=True)
+    for combo in range(combo_of.max() + 1):
+        split(np.flatnonzero(combo_of.ravel() == combo))
+
+    order = np.concatenate(leaves)
+    stops = np.cumsum([len(leaf) for leaf in leaves])
+    starts = stops - np.array([len(leaf) for leaf in leaves])
+    first = order[starts]
+    tree = {'order': order, 'starts': starts, 'stops': stops}
+    for axis in TREE_AXES:
+        values = cohort[axis][order]
+        tree[axis + '_lo'] = np.minimum.reduceat(values, starts)
+        tree[axis + '_hi'] = np.maximum.reduceat(values, starts)
+    for name in TREE_CATEGORIES:
+        tree[name] = cohort[name][first]
+    return tree
+
+
+def leaf_bounds(t, tree, weights, cutoff_ns=None):
+    # Lower bound of the scores in each leaf: the kernel applied to the point of
+    # the leaf's box closest to the target. Leaves that only hold auctions ending
+    # at or after the target (or at or before cutoff_ns) get +inf.
+    closest = {
+        'mileage': np.clip(t['mileage'], tree['mileage_lo'], tree['mileage_hi']),
+        'age': np.clip(t['age'], tree['age_lo'], tree['age_hi']),
+        'end_ns': np.minimum(tree['end_ns_hi'], t['end_ns']),
+        **{name: tree[name] for name in TREE_CATEGORIES},
+    }
+    bounds = distance_kernel(t, closest, weights)
+    bounds[tree['end_ns_lo'] >= t['end_ns']] = np.inf
+    if cutoff_ns is not None:
+        bounds[tree['end_ns_hi'] <= cutoff_ns] = np.inf
+    return bounds
+
+
+def tree_neighbors(t, cohort, tree, weights, k, auction_id=None, cutoff_ns=None):
+    # Exact top-K of the auctions in `cohort` that ended before the target (and
+    # after cutoff_ns, and are not the target itself) -> (positions into cohort, distances)
+    bounds = leaf_bounds(t, tree, weights, cutoff_ns)
+    leaf_order = np.argsort(bounds, kind='stable')
+    found_positions, found_distances = [], []
+    kth = np.inf
+    n_found = 0
+    for step in range(0, len(leaf_order), TREE_LEAVES_PER_STEP):
+        leaves = leaf_order[step:step + TREE_LEAVES_PER_STEP]
+        leaves = leaves[bounds[leaves] <= min(kth, np.finfo(np.float64).max)]  # Ties with the k-th score are kept
+        if len(leaves) == 0:
+            break
+        positions = tree['order'][np.concatenate([np.arange(tree['starts'][leaf], tree['stops'][leaf]) for leaf in leaves])]
+        candidates = {name: cohort[name][positions] for name in ('mileage', 'age', 'end_ns', 'tire', 'heatpump', 'autopilot', 'trust_tier')}
+        distances = distance_kernel(t, candidates, weights)
+        # NO DATA LEAKAGE: only auctions that ended before the target
+        keep = candidates['end_ns'] < t['end_ns']
+        if cutoff_ns is not None:
+            keep &= candidates['end_ns'] > cutoff_ns
+        if auction_id is not None:
+            keep &= cohort['auction_id'][positions] != auction_id
+        found_positions.append(positions[keep])
+        found_distances.append(distances[keep])
+        n_found += int(keep.sum())
+        if n_found >= k:
+            all_distances = np.concatenate(found_distances)
+            kth = np.partition(all_distances, k - 1)[k - 1]
+        profiler.count('tree_leaves_scored', len(leaves))
+
+    if n_found == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    positions = np.concatenate(found_positions)
+    distances = np.concatenate(found_distances)
+    profiler.count('candidates_scored', len(positions))
+    picked = top_k(distances, cohort['row'][positions], k)
+    return positions[picked], distances[picked]
+
+
+# Hard-filter keys (final_approach.md, section 2). Accident-free and priced
+# are applied once when the index is built.
+COHORT_KEYS = ['model', 'variant_clean', 'is_highland', 'tax_type']
+
+
+def cohort_key(target):
+    return (target['model'], target['variant_clean'], bool(target['is_highland']), target['tax_type'])
+
+
+class CohortIndex:
+    # Comparables grouped by cohort key, built once at load time. Each group is a
+    # dict of column arrays sorted by end_time, so "everything that ended before
+    # the target" is a prefix found by binary search. With lookback_days, only
+    # auctions at most that many days older than the target (by the recency
+    # term's day count) are comparables.
+
+    def __init__(self, df, lookback_days=None):
+        if 'end_ns' not in df.columns:
+            df = add_feature_codes(df.copy())
+        self.data = df
+
+        features = encode_features(df)
+        features['row'] = np.arange(len(df))
+        features['auction_id'] = df['auction_id'].to_numpy(dtype=object)
+
+        eligible = np.flatnonzero(
+            df['is_accident_free'].to_numpy(dtype=bool) &  # Comparables must be accident free
+            df['final_price'].notna().to_numpy()           # Must have a price
+        )
+        groups = df.iloc[eligible].groupby(COHORT_KEYS, sort=False, observed=True).indices
+
+        self.cohorts = {}
+        for key, positions in groups.items():
+            rows = eligible[positions]
+            rows = rows[np.argsort(features['end_ns'][rows], kind='stable')]
+            key = (key[0], key[1], bool(key[2]), key[3])
+            self.cohorts[key] = {name: values[rows] for name, values in features.items()}
+        self.trees = {key: build_leaf_tree(cohort) for key, cohort in self.cohorts.items()
+                      if len(cohort['row']) >= TREE_MIN_COHORT}
+        self.lookback_days = lookback_days
+        self._fingerprint = None
+        self._auction_ids = None
+
+    def __len__(self):
+        return sum(len(cohort['row']) for cohort in self.cohorts.values())
+
+    @property
+    def fingerprint(self):
+        # Content hash of the indexed comparables (computed on first use). Any
+        # added, removed or edited auction (or a lookback window) changes it.
+        if self._fingerprint is None:
+            digest = hashlib.sha256()
+            for key in sorted(self.cohorts, key=repr):
+                digest.update(repr(key).encode())
+                for name, values in sorted(self.cohorts[key].items()):
+                    if name == 'auction_id':
+                        values = pd.util.hash_array(values.astype(str))
+                    digest.update(np.ascontiguousarray(values).tobytes())
+            if self.lookback_days is not None:
+                digest.update(f'lookback_days={self.lookback_days}'.encode())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def cutoff_ns(self, end_ns):
+        # Comparables must have ended after this (None: no lookback window)
+        if self.lookback_days is None:
+            return None
+        return end_ns - (int(self.lookback_days) + 1) * DAY_NS
+
+    def __contains__(self, auction_id):
+        if self._auction_ids is None:
+            self._auction_ids = {a for cohort in self.cohorts.values() for a in cohort['auction_id']}
+        return auction_id in self._auction_ids
+
+    def neighbors(self, target, weights, k, price_adjustments):
+        # K nearest comparables of the target -> (cohort arrays, positions,
+        # distances, adjusted prices), or None without comparables. Cohorts
+        # with a tree are searched through it, others are scanned.
+        key = cohort_key(target)
+        tree = self.trees.get(key)
+        if tree is None or not nonnegative_weights(weights):
+            with profiler.stage('cohort_filter'):
+                cohort = self.comparables(target)
+            if cohort is None or len(cohort['row']) == 0:
+                return None
+            profiler.observe('cohort_size', len(cohort['row']))
+            return (cohort, *nearest_neighbors(encode_target(target), cohort, weights, k, price_adjustments))
+
+        cohort = self.cohorts[key]
+        t = encode_target(target)
+        with profiler.stage('tree_search'):
+            positions, distances = tree_neighbors(
+                t, cohort, tree, weights, k, target.get('auction_id'), self.cutoff_ns(t['end_ns']))
+        if len(positions) == 0:
+            return None
+        with profiler.stage('price_adjustment'):
+            adjusted = adjust_prices(t, cohort, positions, price_adjustments)
+        return cohort, positions, distances, adjusted
+
+    def comparables(self, target, end_ns=None):
+        # Column arrays of the target's cohort restricted to auctions that ended
+        # strictly before the target (NO DATA LEAKAGE). Slices are views; a copy
+        # is only made when the target itself has to be dropped.
+        cohort = self.cohorts.get(cohort_key(target))
+        if cohort is None:
+            return None
+        if end_ns is None:
+            end_ns = int(target['end_ns']) if 'end_ns' in target else to_ns(target['end_time'])
+
+        hi = int(np.searchsorted(cohort['end_ns'], end_ns, side='left'))
+        cutoff = self.cutoff_ns(end_ns)
+        lo = 0 if cutoff is None else int(np.searchsorted(cohort['end_ns'], cutoff, side='right'))
+        view = {name: values[lo:hi] for name, values in cohort.items()}
+
+        auction_id = target.get('auction_id')
+        if auction_id is None:  # A car that is not in the data set
+            return view
+        is_self = view['auction_id'] == auction_id
+        if is_self.any():
+            view = {name: values[~is_self] for name, values in view.items()}
+        return view
+
+
+# Single-target valuation
+IDW_EPSILON = 1e-6  # Keeps the weight of an exact match (distance 0) finite
+
+
+class ModelParams(dict):
+    # Parameters of one valuation model: the distance weights plus K_NEIGHBORS
+    # and IDW_POWER (the dict layout every kernel and the optimizer use), with
+    # the price adjustments attached.
+    def __init__(self, weights, price_adjustments):
+        super().__init__(weights)
+        self.price_adjustments = dict(price_adjustments)
+
+    @property
+    def k(self):
+        return int(self['K_NEIGHBORS'])
+
+    @property
+    def idw_power(self):
+        return self['IDW_POWER']
+
+
+def idw_weights(distances, power):
+    # Inverse distance weights: 1 / (distance + epsilon)^p
+    return 1 / ((distances + IDW_EPSILON) ** power)
+
+
+def neighbor_records(cohort, positions, distances, adjusted_prices):
+    return [
+        {'auction_id': auction_id, 'distance': float(distance), 'adjusted_price': float(price)}
+        for auction_id, distance, price in zip(cohort['auction_id'][positions], distances, adjusted_prices)
+    ]
+
+
+def predict(target, index, params):
+    # Value one target (Series or dict) -> (price, number of neighbors,
+    # [{'auction_id', 'distance', 'adjusted_price'}, ...] closest first).
+    # HARD FILTERS (Cohort) are precomputed in the CohortIndex, which only
+    # considers auctions that ended before the target (NO DATA LEAKAGE) and
+    # never the target itself.
+    found = index.neighbors(target, params, params.k, params.price_adjustments)
+    if found is None:
+        return None, 0, []
+    cohort, positions, distances, adjusted_prices = found
+
+    with profiler.stage('idw'):
+        weights = idw_weights(distances, params.idw_power)
+        predicted_price = (adjusted_prices * weights).sum() / weights.sum()
+    neighbors = neighbor_records(cohort, positions, distances, adjusted_prices)
+    return predicted_price, len(neighbors), neighbors
+
+
+def predict_with_band(target, index, params, pool=None):
+    # predict() plus the bootstrap band of the estimate (see bootstrap_band()):
+    # one neighbor search over a pool of BAND_POOL * K comparables, then
+    # vectorized resampling
+    k = params.k
+    found = index.neighbors(target, params, k * (pool or BAND_POOL), params.price_adjustments)
+    if found is None:
+        return None, 0, [], None
+    cohort, positions, distances, adjusted_prices = found
+
+    # The pool is ordered like the top K, so its head is the point estimate's neighbor set
+    positions, nearest, adjusted = positions[:k], distances[:k], adjusted_prices[:k]
+    weights = idw_weights(nearest, params.idw_power)
+    predicted_price = (adjusted * weights).sum() / weights.sum()
+
+    with profiler.stage('band'):
+        band = bootstrap_band(distances, adjusted_prices, k, params.idw_power)
+    neighbors = neighbor_records(cohort, positions, nearest, adjusted)
+    return predicted_price, len(neighbors), neighbors, band
+
+
+def encode_targets(targets):
+    # Column form of encode_target() for a frame of targets
+    features = encode_features(targets)
+    features['is_model_3'] = targets['model'].to_numpy(dtype=object) == 'Model 3'
+    return features
+
+
+def predict_batch(targets, index, params, block_size=4_000_000):
+    # Value every row of `targets` in one call (params: ModelParams, as for
+    # predict()). Targets are grouped by cohort key
+    # so each cohort's arrays are fetched once, and walked in end_time order:
+    # each block of targets is scored as one distance matrix against the prefix
+    # of the cohort that ended before its latest target, so the candidate set
+    # grows with time instead of always spanning the whole cohort; with
+    # non-negative weights the prefix is scanned newest first and older
+    # auctions are pruned once their recency term exceeds every target's K-th
+    # distance (see recent_columns()). Comparables that ended at or after a
+    # target (or are the target itself, or fall outside the lookback window)
+    # are masked to +inf. Cohorts with a tree (see CohortIndex) are instead
+    # searched through it target by target, as predict() does: a tree query
+    # scores a few leaves, far fewer candidates than any prefix scan.
+    # Returns one row per target, in the input order, with the prediction and
+    # the neighbor ids, distances and adjusted prices (closest first).
+    k = params.k
+    pruning = nonnegative_weights(params)
+    tf = encode_targets(targets)
+    target_ids = targets['auction_id'].to_numpy(dtype=object) if 'auction_id' in targets.columns else None
+
+    results = [None] * len(targets)
+    keys = targets[COHORT_KEYS].astype({'is_highland': bool})
+    for key, members in keys.groupby(COHORT_KEYS, sort=False, observed=True).indices.items():
+        cohort = index.cohorts.get(cohort_key(dict(zip(COHORT_KEYS, key))))
+        if cohort is None or len(cohort['row']) == 0:
+            continue
+
+        tree = index.trees.get(cohort_key(dict(zip(COHORT_KEYS, key)))) if pruning else None
+        if tree is not None:
+            for target_pos in members:
+                t = {name: values[target_pos] for name, values in tf.items() if values is not None}
+                own_id = target_ids[target_pos] if target_ids is not None else None
+                with profiler.stage('tree_search'):
+                    positions, nearest = tree_neighbors(t, cohort, tree, params, k, own_id, index.cutoff_ns(t['end_ns']))
+                if len(positions) == 0:
+                    continue
+                with profiler.stage('price_adjustment'):
+                    adjusted = adjust_prices(t, cohort, positions, params.price_adjustments)
+                idw = idw_weights(nearest, params.idw_power)
+                results[target_pos] = {
+                    'predicted_price': (adjusted * idw).sum() / idw.sum(),
+                    'neighbors': len(positions),
+                    'neighbor_ids': list(cohort['auction_id'][positions]),
+                    'neighbor_distances': nearest.tolist(),
+                    'neighbor_adjusted_prices': adjusted.tolist(),
+                }
+            continue
+
+        n = len(cohort['row'])
+        id_position = {auction_id: i for i, auction_id in enumerate(cohort['auction_id'])}
+        members = members[np.argsort(tf['end_ns'][members], kind='stable')]
+        step = max(1, block_size // n)
+        prefix_ends = np.searchsorted(cohort['end_ns'], tf['end_ns'][members], side='left')
+        start = 0
+        while start < len(members):
+            stop = min(start + step, len(members))
+            if pruning:
+                # Keep each block's targets within RECENCY_BLOCK comparables of
+                # each other, so the newest-first scan stops early for all of them
+                stop = max(start + 1, min(stop, int(np.searchsorted(prefix_ends, prefix_ends[start] + RECENCY_BLOCK, side='right'))))
+            block = members[start:stop]
+            start = stop
+            hi = int(prefix_ends[stop - 1])
+            t = {name: values[block][:, None] for name, values in tf.items() if values is not None}
+            t['is_model_3'] = bool(tf['is_model_3'][block[0]])
+            cutoff = index.cutoff_ns(t['end_ns'])
+            lo = 0 if cutoff is None else int(np.searchsorted(cohort['end_ns'], cutoff.min(), side='right'))
+            if hi <= lo:
+                continue
+            own = np.full(len(block), -1)
+            if target_ids is not None:
+                own[:] = [id_position.get(target_ids[target_pos], -1) for target_pos in block]
+
+            def score(a, b, rows=slice(None)):
+                # Distances of the target rows to cohort positions a..b-1,
+                # ineligible ones masked to +inf
+                columns = {name: values[a:b] for name, values in cohort.items()}
+                tr = {name: values[rows] if name != 'is_model_3' else values for name, values in t.items()}
+                distances = distance_kernel(tr, columns, params)
+                # NO DATA LEAKAGE: only auctions that ended before each target
+                distances[columns['end_ns'][None, :] >= tr['end_ns']] = np.inf
+                if cutoff is not None:
+                    distances[columns['end_ns'][None, :] <= cutoff[rows]] = np.inf
+                own_rows = own[rows]
+                is_own = (own_rows >= a) & (own_rows < b)
+                distances[np.flatnonzero(is_own), own_rows[is_own] - a] = np.inf
+                profiler.count('candidates_scored', distances.size)
+                return distances
+
+            with profiler.stage('distance'):
+                if pruning and hi - lo > RECENCY_BLOCK:
+                    lo, distances = recent_columns(t, cohort['end_ns'], lo, hi, params, k, score)
+                else:
+                    distances = score(lo, hi)
+            eligible = {name: values[lo:hi] for name, values in cohort.items()}
+            profiler.observe('cohort_size', hi - lo)
+
+            with profiler.stage('top_k'):
+                positions = top_k_rows(distances, eligible['row'], k)
+                nearest = np.take_along_axis(distances, positions, axis=1)
+            with profiler.stage('price_adjustment'):
+                adjusted = adjust_prices(t, eligible, positions, params.price_adjustments)
+
+            with profiler.stage('idw'):
+                idw = idw_weights(nearest, params.idw_power)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    predicted = (adjusted * idw).sum(axis=1) / idw.sum(axis=1)
+
+            for j, target_pos in enumerate(block):
+                found = np.isfinite(nearest[j])
+                if not found.any():
+                    continue
+                results[target_pos] = {
+                    'predicted_price': predicted[j],
+                    'neighbors': int(found.sum()),
+                    'neighbor_ids': list(eligible['auction_id'][positions[j][found]]),
+                    'neighbor_distances': nearest[j][found].tolist(),
+                    'neighbor_adjusted_prices': adjusted[j][found].tolist(),
+                }
+
+    empty = {'predicted_price': np.nan, 'neighbors': 0, 'neighbor_ids': [],
+             'neighbor_distances': [], 'neighbor_adjusted_prices': []}
+    return pd.DataFrame([r if r is not None else dict(empty) for r in results], index=targets.index)
+
+
+def top_k_rows(distances, rows, k):
+    # top_k() for every row of a distance matrix. Partition once for the whole
+    # matrix, then order the k picks by (distance, row); rows whose k-th value
+    # is tied with an unpicked candidate fall back to top_k() so ties resolve
+    # exactly as in the single-target path.
+    k = min(k, distances.shape[1])
+    picked = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    picked_d = np.take_along_axis(distances, picked, axis=1)
+    order = np.lexsort((rows[picked], picked_d), axis=1)
+    picked = np.take_along_axis(picked, order, axis=1)
+
+    kth = picked_d.max(axis=1)
+    tied = np.flatnonzero((distances <= kth[:, None]).sum(axis=1) > k)
+    for j in tied:
+        picked[j] = top_k(distances[j], rows, k)
+    return picked
+
+
+# Weight-independent form of distance_kernel() for the optimizer: one column
+# of raw penalty terms per weight, so scoring a weight set is a dot product.
+DELTA_WEIGHT_KEYS = [
+    'M3_MILEAGE_PENALTY_PER_KM', 'MY_MILEAGE_PENALTY_PER_KM',
+    'M3_AGE_PENALTY_PER_MONTH', 'MY_AGE_PENALTY_PER_MONTH',
+    'RECENCY_PENALTY_PER_DAY',
+    'TIRE_MISMATCH_8_VS_4', 'TIRE_MISMATCH_4_VS_8', 'TIRE_TYPE_MISMATCH',
+    'HEAT_PUMP_MISMATCH', 'AUTOPILOT_MISMATCH',
+    'TRUST_TIER_2_PENALTY', 'TRUST_TIER_3_PENALTY',
+]
+
+
+def weight_vector(weights):
+    return np.array([weights[key] for key in DELTA_WEIGHT_KEYS], dtype=np.float64)
+
+
+def penalty_components(t, features):
+    # (n, len(DELTA_WEIGHT_KEYS)) matrix of the raw terms distance_kernel()
+    # multiplies by each weight: absolute deltas for the continuous axes, 0/1
+    # flags for mismatches and trust tiers.
+    col = {key: i for i, key in enumerate(DELTA_WEIGHT_KEYS)}
+    components = np.zeros((len(features['mileage']), len(DELTA_WEIGHT_KEYS)))
+    prefix = 'M3' if t['is_model_3'] else 'MY'
+
+    components[:, col[prefix + '_MILEAGE_PENALTY_PER_KM']] = np.abs(t['mileage'] - features['mileage'])
+    components[:, col[prefix + '_AGE_PENALTY_PER_MONTH']] = np.abs(t['age'] - features['age'])
+    components[:, col['RECENCY_PENALTY_PER_DAY']] = np.maximum((t['end_ns'] - features['end_ns']) // DAY_NS, 0)
+
+    c_is_8 = features['tire'] == EIGHT_TIRES_CODE
+    if t['tire'] == EIGHT_TIRES_CODE:
+        components[:, col['TIRE_MISMATCH_8_VS_4']] = ~c_is_8
+    else:
+        components[:, col['TIRE_MISMATCH_4_VS_8']] = c_is_8
+        components[:, col['TIRE_TYPE_MISMATCH']] = ~c_is_8 & (features['tire'] != t['tire'])
+
+    components[:, col['HEAT_PUMP_MISMATCH']] = features['heatpump'] != t['heatpump']
+    components[:, col['AUTOPILOT_MISMATCH']] = features['autopilot'] != t['autopilot']
+    components[:, col['TRUST_TIER_2_PENALTY']] = features['trust_tier'] == TRUST_TIERS.index('Tier 2')
+    components[:, col['TRUST_TIER_3_PENALTY']] = features['trust_tier'] == TRUST_TIERS.index('Tier 3')
+    return components
+
+
+def build_feature_deltas(targets, index, price_adjustments):
+    # Precompute everything about (target, candidate) pairs that does not depend
+    # on the weights: the penalty components and the adjusted prices of each
+    # target's eligible candidates. Built once per validation set. Ragged
+    # layout: the candidates of all targets are concatenated, target j's are
+    # rows offsets[j]:offsets[j + 1], in data-set order so the position within
+    # a target doubles as the tie-breaker.
+    #
+    # Candidate counts first, so the arrays are filled in place rather than
+    # concatenated (which would briefly hold every candidate twice)
+    cohorts = (index.comparables(target) for _, target in targets.iterrows())
+    counts = np.array([len(cohort['row']) if cohort is not None else 0 for cohort in cohorts], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    components = np.empty((offsets[-1], len(DELTA_WEIGHT_KEYS)))
+    adjusted = np.empty(offsets[-1])
+    for j, (_, target) in enumerate(targets.iterrows()):
+        if counts[j] == 0:
+            continue
+        cohort = index.comparables(target)
+        order = np.argsort(cohort['row'], kind='stable')
+        cohort = {name: values[order] for name, values in cohort.items()}
+        t = encode_target(target)
+        components[offsets[j]:offsets[j + 1]] = penalty_components(t, cohort)
+        adjusted[offsets[j]:offsets[j + 1]] = adjust_prices(t, cohort, np.arange(len(order)), price_adjustments)
+
+    actual = targets['final_price'].to_numpy(dtype=np.float64) if 'final_price' in targets.columns else None
+    return {'components': components, 'adjusted_price': adjusted, 'offsets': offsets, 'actual': actual}
+
+
+def select_targets(deltas, selection):
+    # Feature deltas of a subset of the targets (any NumPy index or slice)
+    offsets = deltas['offsets']
+    chosen = np.arange(len(offsets) - 1)[selection]
+    counts = offsets[chosen + 1] - offsets[chosen]
+    new_offsets = np.concatenate([[0], np.cumsum(counts)])
+    # Candidate rows of the chosen targets: each target's run, shifted to its old start
+    rows = np.arange(new_offsets[-1]) + np.repeat(offsets[chosen] - new_offsets[:-1], counts)
+    return {
+        'components': deltas['components'][rows],
+        'adjusted_price': deltas['adjusted_price'][rows],
+        'offsets': new_offsets,
+        'actual': deltas['actual'][chosen] if deltas['actual'] is not None else None,
+    }
+
+
+def predict_from_deltas(deltas, weights, block_size=4_000_000):
+    # Predictions for every target of build_feature_deltas() under one weight
+    # set: one matrix-vector product for all distances, then top-K and IDW per
+    # target. Targets are grouped by candidate count (within a factor of two)
+    # and each group is padded to a matrix of at most block_size entries for
+    # top_k_rows(), so padding never exceeds the candidates themselves. Distances
+    # agree with distance_kernel() up to floating-point rounding of the dot
+    # product. Targets without comparables get NaN.
+    offsets = deltas['offsets']
+    counts = np.diff(offsets)
+    k = min(int(weights['K_NEIGHBORS']), max(int(counts.max(initial=0)), 1))
+    with profiler.stage('distance'):
+        scores = deltas['components'] @ weight_vector(weights)
+    profiler.count('candidates_scored', len(scores))
+
+    # Missing neighbors (fewer than K candidates) keep distance inf and price 0,
+    # which drop out of the IDW sums below
+    nearest = np.full((len(counts), k), np.inf)
+    adjusted = np.zeros((len(counts), k))
+    with profiler.stage('top_k'):
+        order = np.argsort(counts, kind='stable')
+        groups = np.ceil(np.log2(np.maximum(counts[order], 1))).astype(np.int64)
+        for group in np.split(order, np.flatnonzero(np.diff(groups)) + 1):
+            width = int(counts[group].max(initial=0))
+            if width == 0:
+                continue
+            step = max(1, block_size // width)
+            columns = np.arange(width)
+            for start in range(0, len(group), step):
+                block = group[start:start + step]
+                rows = offsets[block][:, None] + columns
+                padded = columns >= counts[block][:, None]
+                rows[padded] = 0
+                block_scores = scores[rows]
+                block_scores[padded] = np.inf
+                positions = top_k_rows(block_scores, columns, k)
+                picked = np.take_along_axis(rows, positions, axis=1)
+                found = ~np.take_along_axis(padded, positions, axis=1)
+                n = positions.shape[1]
+                nearest[block, :n] = np.take_along_axis(block_scores, positions, axis=1)
+                adjusted[block, :n] = np.where(found, deltas['adjusted_price'][picked], 0)
+
+    with profiler.stage('idw'):
+        idw = idw_weights(nearest, weights['IDW_POWER'])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (adjusted * idw).sum(axis=1) / idw.sum(axis=1)
+
+
+# Uncertainty of a valuation from the precomputed neighbor distances. The
+# candidate pool (the BAND_POOL * K nearest comparables) is resampled with
+# replacement BOOTSTRAP_SAMPLES times; every resample is valued with its own
+# K nearest draws, all in one (samples, pool) matrix product. The band spans the
+# central BAND_LEVEL share of these resampled estimates: it shows how much the
+# estimate depends on which comparables happened to sell, and is NOT a
+# prediction interval for the price (on the closed auctions only about half of
+# the actual bids fall inside it). Jackknife / leave-one-out over the K
+# neighbors shows how much a single comparable moves the price.
+BAND_POOL = 5
+BOOTSTRAP_SAMPLES = 100
+BAND_LEVEL = 0.9
+BAND_SEED = 0
+
+
+@functools.lru_cache(maxsize=64)
+def bootstrap_counts(pool, k, samples, seed):
+    # How often each pool entry is among the k nearest draws of every resample,
+    # as a (samples, pool) matrix. Resample indexes only depend on the pool
+    # size, so they are drawn once. Pool entries are sorted by distance, so the
+    # k smallest indexes of a resample are its k nearest comparables.
+    draws = np.random.default_rng(seed).integers(0, pool, size=(samples, pool))
+    nearest = np.partition(draws, k - 1, axis=1)[:, :k] if k < pool else draws
+    counts = np.zeros((samples, pool))
+    np.add.at(counts, (np.arange(samples)[:, None], nearest), 1)
+    counts.setflags(write=False)
+    return counts
+
+
+def bootstrap_band(distances, adjusted_prices, k, idw_power, samples=BOOTSTRAP_SAMPLES,
+                   level=BAND_LEVEL, seed=BAND_SEED):
+    # distances / adjusted_prices: the candidate pool, nearest first (the first
+    # k are the neighbors of the point estimate). Returns a dict of bounds.
+    pool = len(distances)
+    k = min(k, pool)
+    idw = idw_weights(distances, idw_power)
+    weighted = adjusted_prices * idw
+
+    sums = bootstrap_counts(pool, k, samples, seed) @ np.column_stack([weighted, idw])
+    boot = np.sort(sums[:, 0] / sums[:, 1])
+    # Percentiles with linear interpolation, as np.quantile (samples >= 2)
+    def percentile(q):
+        position = q * (samples - 1)
+        i = min(int(position), samples - 2)
+        return float(boot[i] + (position - i) * (boot[i + 1] - boot[i]))
+
+    deviations = boot - boot.sum() / samples
+    band = {
+        'low': percentile((1 - level) / 2),
+        'high': percentile((1 + level) / 2),
+        'band_level': level,
+        'bootstrap_std': math.sqrt(deviations @ deviations / (samples - 1)),
+        'loo_low': float('nan'),
+        'loo_high': float('nan'),
+        'jackknife_se': float('nan'),
+    }
+    if k >= 2:
+        # Leave-one-out: drop each of the k neighbors in turn
+        loo = (weighted[:k].sum() - weighted[:k]) / (idw[:k].sum() - idw[:k])
+        deviations = loo - loo.sum() / k
+        band.update({
+            'loo_low': float(loo.min()),
+            'loo_high': float(loo.max()),
+            'jackknife_se': math.sqrt((k - 1) / k * (deviations @ deviations)),
+        })
+    return band
@@ -0,0 +1,439 @@
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from dataset_cache import load_clean_data, source_stamp
+from validate_algo import (
+    INPUT_FILE, LOOKBACK_DAYS, MODEL_PARAMS, closed_auctions, predict_band, predict_valuation,
+)
+from valuation_cache import ValuationCache
+from valuation_engine import (
+    FLAG_COLUMNS, REQUIRED_FIELDS, TARGET_DEFAULTS, TRUE_VALUES, CohortIndex, add_feature_codes, age_in_months,
+    predict_batch,
+)
+
+# Long-lived valuation service. Loads the cleaned data set and the cohort index
+# once and answers over plain HTTP/1.1 (asyncio, standard library only):
+#
+#   GET  /health          data set size, fingerprint and cache stats
+#   POST /valuate         one target car (JSON object) -> price + neighbors
+#                         (+ the bootstrap band of the estimate with "band": true;
+#                         a spread of resampled estimates, not a price interval)
+#   POST /valuate/batch   {"targets": [...]} -> one result per target
+#
+# Targets use the cleaned column names (tesla_final_clean.csv). end_time
+# defaults to now, floored to LIVE_TIME_STEP: live lookups of the same car
+# within one step share a valuation cache entry (auctions that ended earlier
+# in the current step are not comparables yet); age_at_auction_months can be given directly or derived from
+# first_registration. The data set is reloaded when the CSV changes on disk,
+# which also invalidates the valuation cache. Requests are handled on worker
+# threads and a reload builds the new data set before swapping it in, so a
+# long batch or a reload never blocks other connections.
+#
+#   python valuation_server.py --port 8000
+#   python valuation_server.py --self-test
+
+HOST = '127.0.0.1'
+PORT = 8000
+MAX_BODY = 10 * 1024 * 1024
+LIVE_TIME_STEP = '1h'  # Granularity of the default end_time
+NEIGHBOR_FIELDS = ['variant_clean', 'mileage', 'age_at_auction_months', 'end_time', 'final_price',
+                   'tire_strategy', 'autopilot', 'has_heatpump', 'has_hitch', 'trust_tier', 'status']
+REASONS = {200: 'OK', 204: 'No Content', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+def parse_target(payload):
+    # Target row (dict) from a request object; raises ValueError on bad input
+    if not isinstance(payload, dict):
+        raise ValueError("target must be a JSON object")
+    missing = [field for field in REQUIRED_FIELDS if payload.get(field) is None]
+    if missing:
+        raise ValueError(f"missing field(s): {', '.join(missing)}")
+    if payload['model'] not in ('Model 3', 'Model Y'):
+        raise ValueError("model must be 'Model 3' or 'Model Y'")
+
+    target = {**TARGET_DEFAULTS, **{k: v for k, v in payload.items() if v is not None}}
+    try:
+        target['mileage'] = float(target['mileage'])
+        end_time = pd.Timestamp(target.get('end_time') or pd.Timestamp.now(tz='UTC').floor(LIVE_TIME_STEP))
+        target['end_time'] = end_time.tz_convert(None) if end_time.tzinfo else end_time
+        if target.get('age_at_auction_months') is None:
+            if target.get('first_registration') is None:
+                raise ValueError("age_at_auction_months or first_registration is required")
+            age = age_in_months(target['end_time'], pd.Timestamp(target['first_registration']))
+            if math.isnan(age):
+                raise ValueError("first_registration is not a date")
+            target['age_at_auction_months'] = age
+        target['age_at_auction_months'] = float(target['age_at_auction_months'])
+    except (TypeError, ValueError) as e:
+        raise ValueError(str(e)) from None
+    for flag in FLAG_COLUMNS:
+        # JSON booleans, or the spellings batch_valuation.py accepts ("false" is False)
+        target[flag] = str(target[flag]).lower() in TRUE_VALUES
+    return target
+
+
+# One loaded data set; swapped as a whole on reload
+Dataset = namedtuple('Dataset', ['df', 'index', 'positions'])
+
+
+def json_value(value):
+    if isinstance(value, (np.bool_, bool)):
+        return bool(value)
+    if isinstance(value, (np.integer, int)):
+        return int(value)
+    if isinstance(value, (np.floating, float)):
+        return None if math.isnan(value) else float(value)
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    return value
+
+
+class ValuationService:
+    def __init__(self, csv_path=INPUT_FILE, lookback_days=LOOKBACK_DAYS):
+        self.csv_path = csv_path
+        self.lookback_days = lookback_days
+        self.stamp = None
+        self.data = None
+        self.reload_lock = threading.Lock()
+        self.cache = ValuationCache()
+        self.refresh()
+
+    @property
+    def df(self):
+        return self.data.df
+
+    @property
+    def index(self):
+        return self.data.index
+
+    def refresh(self):
+        # Reload when the cleaned CSV changed since the last load -> current
+        # Dataset. Requests run concurrently and each keeps the Dataset it
+        # started with: one request builds the new Dataset while the others
+        # are still served from the previous one, then it is swapped in.
+        if source_stamp(self.csv_path) != self.stamp and self.reload_lock.acquire(blocking=self.data is None):
+            try:
+                stamp = source_stamp(self.csv_path)
+                if stamp != self.stamp:
+                    df = add_feature_codes(load_clean_data(self.csv_path))
+                    positions = pd.Series(np.arange(len(df)), index=df['auction_id'].astype(str))
+                    self.data = Dataset(df, CohortIndex(df, self.lookback_days), positions)
+                    self.stamp = stamp
+            finally:
+                self.reload_lock.release()
+        return self.data
+
+    def explain(self, data, neighbor_ids, distances, adjusted_prices):
+        # Neighbor explanations: distance, adjusted price and the comparable itself
+        rows = data.df.iloc[data.positions.loc[[str(a) for a in neighbor_ids]].to_numpy()]
+        return [
+            {
+                'auction_id': str(auction_id),
+                'distance': json_value(distance),
+                'adjusted_price': json_value(price),
+                **{field: json_value(value) for field, value in zip(NEIGHBOR_FIELDS, row)},
+            }
+            for auction_id, distance, price, row in zip(
+                neighbor_ids, distances, adjusted_prices, rows[NEIGHBOR_FIELDS].itertuples(index=False))
+        ]
+
+    def valuate(self, payload):
+        data = self.refresh()
+        target = parse_target(payload)
+        if target.pop('band', False):
+            predicted_price, n, neighbors, band = predict_band(target, data.index)
+        else:
+            predicted_price, n, neighbors = predict_valuation(target, data.index, cache=self.cache)
+            band = None
+        response = {
+            'predicted_price': json_value(predicted_price),
+            'num_neighbors': n,
+            'neighbors': self.explain(
+                data,
+                [nb['auction_id'] for nb in neighbors],
+                [nb['distance'] for nb in neighbors],
+                [nb['adjusted_price'] for nb in neighbors],
+            ),
+        }
+        if band is not None:
+            response['band'] = {name: json_value(value) for name, value in band.items()}
+        return response
+
+    def valuate_batch(self, payload):
+        data = self.refresh()
+        if not isinstance(payload, dict) or not isinstance(payload.get('targets'), list):
+            raise ValueError('expected {"targets": [...]}')
+        targets = []
+        for i, item in enumerate(payload['targets']):
+            try:
+                targets.append(parse_target(item))
+            except ValueError as e:
+                raise ValueError(f"targets[{i}]: {e}") from None
+        if not targets:
+            return {'results': []}
+        predictions = predict_batch(pd.DataFrame(targets), data.index, MODEL_PARAMS)
+        # Every neighbor of the batch is looked up at once, then split per target
+        columns = ['neighbor_ids', 'neighbor_distances', 'neighbor_adjusted_prices']
+        explained = self.explain(data, *(list(itertools.chain.from_iterable(predictions[c])) for c in columns))
+        counts = predictions['neighbors'].to_numpy()
+        return {'results': [
+            {
+                'predicted_price': json_value(price),
+                'num_neighbors': int(n),
+                'neighbors': explained[stop - n:stop],
+            }
+            for price, n, stop in zip(predictions['predicted_price'], counts, np.cumsum(counts))
+        ]}
+
+    def health(self):
+        data = self.data
+        return {
+            'status': 'ok',
+            'rows': len(data.df),
+            'comparables': len(data.index),
+            'fingerprint': data.index.fingerprint,
+            'cache': self.cache.stats(),
+        }
+
+
+def route(service, method, path, body):
+    # -> (status, response object)
+    handlers = {
+        '/health': ('GET', lambda _: service.health()),
+        '/valuate': ('POST', service.valuate),
+        '/valuate/batch': ('POST', service.valuate_batch),
+    }
+    if path not in handlers:
+        return 404, {'error': f"no such endpoint: {path}"}
+    expected, handler = handlers[path]
+    if method != expected:
+        return 405, {'error': f"use {expected} for {path}"}
+    try:
+        payload = json.loads(body) if body else None
+        return 200, handler(payload)
+    except ValueError as e:  # includes malformed JSON
+        return 400, {'error': str(e)}
+
+
+def respond(service, method, path, body):
+    # -> (status, encoded JSON body)
+    try:
+        status, response = route(service, method, path, body)
+    except Exception as e:
+        status, response = 500, {'error': f"{type(e).__name__}: {e}"}
+    return status, json.dumps(response).encode()
+
+
+async def handle_connection(service, reader, writer):
+    # Minimal HTTP/1.1 with keep-alive; one request at a time per connection
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            try:
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+            except ValueError:
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            try:
+                length = int(headers.get('content-length') or 0)
+            except ValueError:
+                length = -1
+            if length < 0:
+                status, data = 400, json.dumps({'error': "invalid Content-Length"}).encode()
+            elif length > MAX_BODY:
+                status, data = 413, json.dumps({'error': f"body larger than {MAX_BODY} bytes"}).encode()
+            else:
+                # The body is read even when unused, so the next request on
+                # the connection starts at the right byte
+                body = await reader.readexactly(length) if length else b''
+                if method == 'OPTIONS':  # CORS preflight from the widget
+                    status, data = 204, b''
+                else:
+                    # Valuations, reloads and encoding run on a worker thread
+                    status, data = await asyncio.to_thread(respond, service, method, target.split('?', 1)[0], body)
+
+            # Without a usable length the rest of the stream cannot be framed
+            keep_alive = headers.get('connection', '').lower() != 'close' and 0 <= length <= MAX_BODY
+            writer.write(
+                f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(data)}\r\n"
+                f"Access-Control-Allow-Origin: *\r\n"
+                f"Access-Control-Allow-Methods: GET, POST, OPTIONS\r\n"
+                f"Access-Control-Allow-Headers: Content-Type\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + data
+            )
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(service, host=HOST, port=PORT):
+    server = await asyncio.start_server(lambda r, w: handle_connection(service, r, w), host, port)
+    address = server.sockets[0].getsockname()
+    print(f"Serving valuations for {len(service.df)} auctions on http://{address[0]}:{address[1]}")
+    async with server:
+        await server.serve_forever()
+
+
+async def request(host, port, method, path, payload=None):
+    # Tiny HTTP client for --self-test -> (status, decoded JSON)
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps(payload).encode() if payload is not None else b''
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    while (await reader.readline()) not in (b'\r\n', b''):
+        pass
+    data = await reader.read()
+    writer.close()
+    return status, json.loads(data) if data else None
+
+
+async def exchange(host, port, raw):
+    # Send raw request bytes on one connection -> statuses of every response
+    # until the server closes it
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(raw)
+    await writer.drain()
+    statuses = []
+    while status_line := await reader.readline():
+        statuses.append(int(status_line.split()[1]))
+        length = 0
+        while (line := await reader.readline()) not in (b'\r\n', b''):
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.lower() == 'content-length':
+                length = int(value)
+        await reader.readexactly(length)
+    writer.close()
+    return statuses
+
+
+async def self_test(service, n_targets=10):
+    # Start on a free port, value recent closed auctions over HTTP and compare
+    # with predict_valuation() called directly
+    server = await asyncio.start_server(lambda r, w: handle_connection(service, r, w), HOST, 0)
+    port = server.sockets[0].getsockname()[1]
+    targets = closed_auctions(service.df).sort_values('end_time').tail(n_targets)
+    payloads = [
+        {**{k: json_value(v) for k, v in row.items() if k in TARGET_DEFAULTS or k in REQUIRED_FIELDS},
+         'auction_id': row['auction_id'], 'end_time': row['end_time'].isoformat(),
+         'age_at_auction_months': json_value(row['age_at_auction_months'])}
+        for _, row in targets.iterrows()
+    ]
+    failures = 0
+
+    def check(label, ok):
+        nonlocal failures
+        failures += not ok
+        print(f"  {'ok  ' if ok else 'FAIL'} {label}")
+
+    async with server:
+        status, health = await request(HOST, port, 'GET', '/health')
+        check(f"/health -> {status}, {health['rows'] if health else '?'} rows", status == 200)
+
+        batch_status, batch = await request(HOST, port, 'POST', '/valuate/batch', {'targets': payloads})
+        check(f"/valuate/batch -> {batch_status}", batch_status == 200 and len(batch['results']) == len(payloads))
+        for payload, (_, row), result in zip(payloads, targets.iterrows(), batch['results'] if batch else []):
+            expected, n, neighbors = predict_valuation(row, service.index, cache=None)
+            status, single = await request(HOST, port, 'POST', '/valuate', payload)
+            same = (status == 200 and single['num_neighbors'] == n == result['num_neighbors']
+                    and [nb['auction_id'] for nb in single['neighbors']] == [nb['auction_id'] for nb in neighbors]
+                    and (expected is None or math.isclose(single['predicted_price'], expected, rel_tol=1e-12)
+                         and math.isclose(result['predicted_price'], expected, rel_tol=1e-12)))
+            check(f"/valuate {payload['auction_id'][:8]} -> {single['predicted_price'] if single else None}", same)
+
+        status, result = await request(HOST, port, 'POST', '/valuate', {**payloads[-1], 'band': True})
+        band = result.get('band') if result else None
+        check(f"/valuate with band -> {status}, {band and (round(band['low']), round(band['high']))}",
+              status == 200 and band is not None and band['low'] <= band['high'])
+
+        # A large batch runs off the event loop: /health answers meanwhile
+        started = time.perf_counter()
+        large = asyncio.ensure_future(request(HOST, port, 'POST', '/valuate/batch', {'targets': payloads * 300}))
+        await asyncio.sleep(0.02)
+        status, _ = await request(HOST, port, 'GET', '/health')
+        health_seconds = time.perf_counter() - started
+        batch_status, _ = await large
+        batch_seconds = time.perf_counter() - started
+        check(f"/health during a {len(payloads) * 300}-target batch -> {status} after {health_seconds * 1e3:.0f} ms "
+              f"(batch {batch_seconds * 1e3:.0f} ms)", status == batch_status == 200 and health_seconds < batch_seconds / 2)
+
+        # Live lookups (no end_time) of the same car hit the cache after the first
+        live = {k: v for k, v in payloads[-1].items() if k not in ('auction_id', 'end_time')}
+        hits = service.cache.hits
+        statuses = [(await request(HOST, port, 'POST', '/valuate', live))[0] for _ in range(3)]
+        check(f"repeated live lookups -> {service.cache.hits - hits} cache hit(s)",
+              statuses == [200] * 3 and service.cache.hits - hits >= 2)
+
+        # Flags sent as strings mean what batch_valuation.py reads them as
+        spelled = {**payloads[-1], **{flag: str(bool(payloads[-1][flag])).lower() for flag in FLAG_COLUMNS}}
+        status, result = await request(HOST, port, 'POST', '/valuate', spelled)
+        _, plain = await request(HOST, port, 'POST', '/valuate', payloads[-1])
+        check(f"flags as strings -> {status}", status == 200 and result == plain)
+
+        # A preflight body is consumed; a malformed length is refused and closes
+        statuses = await exchange(HOST, port, (
+            f"OPTIONS /valuate HTTP/1.1\r\nHost: {HOST}\r\nContent-Length: 2\r\n\r\n{{}}"
+            f"GET /health HTTP/1.1\r\nHost: {HOST}\r\nConnection: close\r\n\r\n").encode())
+        check(f"OPTIONS with a body, then /health -> {statuses}", statuses == [204, 200])
+        statuses = await exchange(HOST, port, (
+            f"POST /valuate HTTP/1.1\r\nHost: {HOST}\r\nContent-Length: ten\r\n\r\n{{}}").encode())
+        check(f"malformed Content-Length -> {statuses}", statuses == [400])
+
+        status, _ = await request(HOST, port, 'POST', '/valuate', {'model': 'Model 3'})
+        check(f"incomplete target -> {status}", status == 400)
+        status, _ = await request(HOST, port, 'GET', '/valuate')
+        check(f"wrong method -> {status}", status == 405)
+        status, _ = await request(HOST, port, 'GET', '/nope')
+        check(f"unknown path -> {status}", status == 404)
+    print(f"Self-test: {failures} failure(s)")
+    return failures == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve valuations over HTTP with the data set held in memory.")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--input', default=INPUT_FILE, help="Cleaned data set")
+    parser.add_argument('--lookback-days', type=int, default=LOOKBACK_DAYS, help="Only use comparables that ended at most this many days before the target")
+    parser.add_argument('--self-test', action='store_true', help="Start on a free local port, exercise every endpoint and exit")
+    args = parser.parse_args()
+
+    service = ValuationService(args.input, args.lookback_days)
+    if args.self_test:
+        raise SystemExit(0 if asyncio.run(self_test(service)) else 1)
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()